@@ -0,0 +1,90 @@
+"""
+Microbenchmark of token verification, with and without the verified-claims cache.
+
+Measures the get_user_id dependency called directly, and resolved by FastAPI for a
+request to a minimal authenticated route. Run from backend/:
+
+    python -m benchmarks.auth_bench [--iterations N] [--json]
+"""
+import json
+import time
+import argparse
+from datetime import timedelta
+
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from utils import security
+from utils.lru_cache import LRUCache
+
+
+def _time_per_call(fn, iterations: int) -> float:
+    """Mean microseconds per call"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+def run(iterations: int = 20000) -> dict:
+    token = security.create_access_token({"sub": "bench@example.com", "name": "Bench"}, timedelta(minutes=30))
+    app = FastAPI()
+
+    @app.get("/whoami")
+    def whoami(user_id: str = Depends(security.get_user_id)):
+        return {"user_id": user_id}
+
+    client = TestClient(app)
+    headers = {"Authorization": f"Bearer {token}"}
+    requests = max(1, iterations // 20)
+
+    cache = security.token_cache
+    results = {}
+    try:
+        for mode, token_cache in (("uncached", LRUCache(max_entries=0)), ("cached", LRUCache(max_entries=1024))):
+            security.token_cache = token_cache
+            security.get_user_id(token)  # warm up
+            client.get("/whoami", headers=headers)
+            results[mode] = {
+                "dependency_us": _time_per_call(lambda: security.get_user_id(token), iterations),
+                "request_us": _time_per_call(lambda: client.get("/whoami", headers=headers), requests),
+            }
+    finally:
+        security.token_cache = cache
+
+    results["speedup"] = {
+        metric: results["uncached"][metric] / results["cached"][metric] for metric in ("dependency_us", "request_us")
+    }
+    return results
+
+def run_suite(quick: bool = False) -> list:
+    """Results as rows for benchmarks.run"""
+    from benchmarks.common import record
+
+    iterations = 2000 if quick else 20000
+    results = run(iterations)
+    return [
+        record("auth", mode, {"iterations": iterations}, {
+            "dependency_us": results[mode]["dependency_us"],
+            "request_ms": results[mode]["request_us"] / 1000,
+        })
+        for mode in ("uncached", "cached")
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000, help="dependency calls per mode; requests are 1/20th")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+    if args.json:
+        print(json.dumps(results))
+        return
+    print(f"{'':10}{'dependency (us)':>18}{'request (us)':>16}")
+    for mode in ("uncached", "cached"):
+        print(f"{mode:10}{results[mode]['dependency_us']:>18.2f}{results[mode]['request_us']:>16.1f}")
+    print(f"{'speedup':10}{results['speedup']['dependency_us']:>17.1f}x{results['speedup']['request_us']:>15.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""End-to-end /chat/ask: latency percentiles and throughput under concurrent clients, on the stub model"""
+import io
+import time
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from PIL import Image
+
+from benchmarks.common import latency_metrics, record
+
+SUITE = "chat"
+
+
+def _png() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (512, 512), (180, 40, 40)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+async def _load(app, headers: Dict[str, str], variant: str, concurrency: int, requests: int, png: bytes, session_id: str) -> Dict[str, Any]:
+    import httpx
+
+    durations = []
+    statuses: Dict[int, int] = {}
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def client_loop(client):
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            # Unique questions, so no answer is served from the answer cache
+            data = {"question": f"{variant} {concurrency} {i}: is this result within the normal range?"}
+            files = None
+            if variant == "image":
+                files = {"file": ("scan.png", png, "image/png")}
+            elif variant == "session":
+                data["session_id"] = session_id
+            started = time.perf_counter()
+            response = await client.post("/chat/ask", data=data, files=files, headers=headers)
+            elapsed = time.perf_counter() - started
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if response.status_code == 200:
+                durations.append(elapsed)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    metrics = latency_metrics(durations, elapsed)
+    metrics["rejected"] = statuses.get(503, 0)
+    metrics["errors"] = sum(count for status, count in statuses.items() if status not in (200, 503))
+    return metrics
+
+def run_suite(quick: bool = False) -> List[Dict[str, Any]]:
+    import main
+    from routers import model_api
+    from routers.chat_history import history_store
+    from utils.security import create_access_token
+
+    model_api.load_model()
+    user_id = "chat-bench@example.com"
+    token = create_access_token({"sub": user_id, "name": "Bench"}, timedelta(hours=1))
+    headers = {"Authorization": f"Bearer {token}"}
+    session_id = "chat-bench-session"
+    history_store.create_session(user_id, {
+        "id": session_id,
+        "title": "Bench",
+        "created_at": datetime(2024, 1, 1).isoformat(),
+        "messages": [
+            {"sender": "user" if i % 2 == 0 else "ai", "text": f"Earlier turn {i} about blood pressure readings.",
+             "timestamp": datetime(2024, 1, 1).isoformat()}
+            for i in range(20)
+        ],
+    })
+
+    png = _png()
+    results = []
+    for variant in ("text", "image", "session"):
+        for concurrency in ((1, 8) if quick else (1, 8, 32)):
+            requests = max(16 if quick else 64, concurrency * 4)
+            metrics = asyncio.run(_load(main.app, headers, variant, concurrency, requests, png, session_id))
+            results.append(record(SUITE, "ask", {"variant": variant, "concurrency": concurrency, "requests": requests}, metrics))
+    return results
@@ -0,0 +1,144 @@
+"""
+Shared setup and measurement helpers for the benchmark suites.
+
+Every suite runs against a throwaway working directory (uploads, chat history, caches)
+and the deterministic fake inference backend, so results need no model, network or
+existing data. ``prepare_environment`` must run before any backend module is imported:
+their settings are read from the environment at import time.
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import statistics
+import subprocess
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stub model settings; FAKE_INFERENCE_DELAY_MS is per generated word
+STUB_ENVIRONMENT = {
+    "INFERENCE_BACKEND": "fake",
+    "MODEL_PRELOAD": "false",
+    "FAKE_INFERENCE_DELAY_MS": "2",
+    "UPLOAD_GC_INTERVAL_SECONDS": "0",
+    "ANSWER_CACHE_PATH": "",
+}
+
+
+def prepare_environment(workdir: Optional[str] = None, **overrides: str) -> str:
+    """Switch to a fresh working directory with the stub model configured; returns the directory"""
+    workdir = workdir or tempfile.mkdtemp(prefix="health-assistant-bench-")
+    os.makedirs(os.path.join(workdir, "uploads"), exist_ok=True)
+    for name, value in {**STUB_ENVIRONMENT, **overrides}.items():
+        os.environ.setdefault(name, value)
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    os.chdir(workdir)
+    random.seed(0)
+    return workdir
+
+
+def percentile(sorted_values: Sequence[float], q: float) -> float:
+    """Linear-interpolated percentile of already sorted values, ``q`` in [0, 100]"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+def latency_metrics(durations: Sequence[float], elapsed: Optional[float] = None) -> Dict[str, float]:
+    """Latency summary in milliseconds of per-operation durations in seconds"""
+    values = sorted(durations)
+    metrics = {
+        "count": len(values),
+        "mean_ms": statistics.fmean(values) * 1000 if values else 0.0,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "max_ms": values[-1] * 1000 if values else 0.0,
+    }
+    total = elapsed if elapsed is not None else sum(values)
+    metrics["ops_per_sec"] = len(values) / total if total > 0 else 0.0
+    return metrics
+
+def measure(fn: Callable[[], Any], iterations: int, warmup: int = 1) -> Dict[str, float]:
+    """Call ``fn`` repeatedly and summarize the latency of each call"""
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - started)
+    return latency_metrics(durations)
+
+def record(suite: str, name: str, params: Dict[str, Any], metrics: Dict[str, Any]) -> Dict[str, Any]:
+    """One result row; (suite, name, params) identify it across runs"""
+    return {"suite": suite, "name": name, "params": params, "metrics": metrics}
+
+def skipped(suite: str, reason: str) -> Dict[str, Any]:
+    return {"suite": suite, "name": "skipped", "params": {}, "metrics": {}, "skipped": reason}
+
+def result_key(row: Dict[str, Any]) -> str:
+    return f"{row['suite']}/{row['name']}{json.dumps(row['params'], sort_keys=True)}"
+
+
+def _git(*args: str) -> Optional[str]:
+    try:
+        return subprocess.run(["git", *args], cwd=BACKEND_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_metadata() -> Dict[str, Any]:
+    """Where and on what the results were produced, so runs on different commits can be compared"""
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "stub_model": {name: os.environ.get(name) for name in ("INFERENCE_BACKEND", "FAKE_INFERENCE_DELAY_MS")},
+    }
+
+def _failure_count(metric: str) -> bool:
+    return metric in ("errors", "rejected") or metric.endswith("_errors")
+
+def compare(baseline: List[Dict[str, Any]], current: List[Dict[str, Any]], threshold: float = 0.10) -> List[Dict[str, Any]]:
+    """
+    Relative change of every shared metric between two result lists. Changes beyond
+    ``threshold`` are flagged; for *_ms and *_us metrics lower is better, for *per_sec
+    higher is. Failures are judged without a threshold: any lost update, and any more
+    errors or rejections than the baseline had, is "worse".
+    """
+    before = {result_key(row): row for row in baseline}
+    changes = []
+    for row in current:
+        old = before.get(result_key(row))
+        if old is None:
+            continue
+        for metric, value in row["metrics"].items():
+            old_value = old["metrics"].get(metric)
+            failures = metric == "lost_updates" or _failure_count(metric)
+            if failures:
+                old_value = old_value or 0
+            if not isinstance(value, (int, float)) or not isinstance(old_value, (int, float)) or not (old_value or failures):
+                continue
+            change = (value - old_value) / old_value if old_value else float("inf") if value else 0.0
+            if failures:
+                worse = value > 0 if metric == "lost_updates" else value > old_value
+                verdict = "worse" if worse else "better" if value < old_value else "same"
+            elif metric.endswith(("_ms", "_us")):
+                verdict = "slower" if change > threshold else "faster" if change < -threshold else "same"
+            elif metric.endswith("per_sec"):
+                verdict = "faster" if change > threshold else "slower" if change < -threshold else "same"
+            else:
+                continue
+            changes.append({"key": result_key(row), "metric": metric, "before": old_value, "after": value,
+                            "change": change, "verdict": verdict})
+    return changes
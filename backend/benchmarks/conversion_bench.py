@@ -0,0 +1,57 @@
+"""PDF conversion: page count, single-page rendering and parallel rendering at several page counts"""
+import shutil
+from typing import Any, Dict, List
+
+from PIL import Image, ImageDraw
+
+from benchmarks.common import measure, record, skipped
+
+SUITE = "conversion"
+
+
+def make_pdf(path: str, pages: int) -> str:
+    """A letter-sized PDF of ``pages`` pages with a little text and line art on each"""
+    images = []
+    for number in range(1, pages + 1):
+        page = Image.new("RGB", (1275, 1650), "white")
+        draw = ImageDraw.Draw(page)
+        draw.text((100, 100), f"Lab report page {number}", fill="black")
+        for row in range(40):
+            draw.line((100, 200 + row * 30, 1175, 200 + row * 30), fill=(200, 200, 200))
+            draw.text((110, 205 + row * 30), f"Result {row}: {row * 7 % 13}.{row % 10} mmol/L", fill="black")
+        images.append(page)
+    images[0].save(path, format="PDF", save_all=True, append_images=images[1:], resolution=150)
+    return path
+
+def run_suite(quick: bool = False) -> List[Dict[str, Any]]:
+    # pdf2image shells out to poppler; without it there is nothing to measure
+    if shutil.which("pdftoppm") is None or shutil.which("pdfinfo") is None:
+        return [skipped(SUITE, "poppler (pdftoppm/pdfinfo) is not installed")]
+
+    from utils.conversion import conversion_service, render_pdf_pages
+    from utils.pdf_render import pdf_page_count, render_pdf_page
+    from utils.render_cache import RenderCache
+
+    iterations = 3 if quick else 10
+    results = []
+    try:
+        for pages in ((1, 5) if quick else (1, 5, 20)):
+            pdf_path = make_pdf(f"bench-{pages}.pdf", pages)
+            params = {"pages": pages}
+            results.append(record(SUITE, "page_count", params, measure(lambda: pdf_page_count(pdf_path), iterations)))
+            results.append(record(SUITE, "render_page", {**params, "max_side": 896}, measure(
+                lambda: render_pdf_page(pdf_path, 1, max_side=896), iterations)))
+
+            metrics = measure(lambda: render_pdf_pages(pdf_path, list(range(1, pages + 1)), max_side=896), iterations)
+            metrics["pages_per_sec"] = pages / (metrics["mean_ms"] / 1000)
+            results.append(record(SUITE, "render_all_pages", {**params, "max_side": 896}, metrics))
+
+            # The render cache in front of the last page: first lookup renders, later ones read the stored image
+            cache = RenderCache(directory=f"render-cache-{pages}")
+            results.append(record(SUITE, "render_cache_miss", params, measure(
+                lambda: cache.get(pdf_path, pages, max_side=896), 1, warmup=0)))
+            results.append(record(SUITE, "render_cache_hit", params, measure(
+                lambda: cache.get(pdf_path, pages, max_side=896), iterations)))
+    finally:
+        conversion_service.shutdown()
+    return results
@@ -0,0 +1,94 @@
+"""History storage: append and list at varying history sizes, and concurrent same-user writes"""
+import time
+import threading
+from datetime import datetime
+from typing import Any, Dict, List
+
+from benchmarks.common import latency_metrics, measure, record
+
+SUITE = "history"
+
+
+def _message(i: int) -> Dict[str, Any]:
+    return {
+        "sender": "user" if i % 2 == 0 else "ai",
+        "text": f"Message {i}: the patient reports intermittent chest pain after exercise. " * 3,
+        "timestamp": datetime(2024, 1, 1).isoformat(),
+    }
+
+def _session(session_id: str, messages: int) -> Dict[str, Any]:
+    return {
+        "id": session_id,
+        "title": session_id,
+        "created_at": datetime(2024, 1, 1).isoformat(),
+        "messages": [_message(i) for i in range(messages)],
+    }
+
+def _seed(store, user_id: str, sessions: int, messages: int):
+    for s in range(sessions):
+        store.create_session(user_id, _session(f"session_{s}", messages))
+
+def _store(backend: str, directory: str):
+    from utils.history_store import JSONHistoryStore, SQLiteHistoryStore
+
+    if backend == "json":
+        return JSONHistoryStore(directory=directory)
+    return SQLiteHistoryStore(db_path=f"{directory}/history.sqlite3")
+
+def run_suite(quick: bool = False) -> List[Dict[str, Any]]:
+    sizes = (10, 100) if quick else (10, 100, 1000)
+    iterations = 20 if quick else 100
+    results = []
+    for backend in ("json", "sqlite"):
+        for size in sizes:
+            store = _store(backend, f"history-{backend}-{size}")
+            user_id = f"user-{size}"
+            # Ten sessions of ``size`` messages; the last one is appended to and read
+            _seed(store, user_id, 10, size)
+            params = {"backend": backend, "messages_per_session": size, "sessions": 10}
+            counter = iter(range(size, size + iterations + 10))
+
+            results.append(record(SUITE, "append", params, measure(
+                lambda: store.append_message(user_id, "session_9", _message(next(counter))), iterations)))
+            results.append(record(SUITE, "list_sessions", params, measure(
+                lambda: store.list_sessions(user_id), iterations)))
+            results.append(record(SUITE, "page_messages", {**params, "limit": 50}, measure(
+                lambda: store.page_messages(user_id, "session_9", 50), iterations)))
+            # A fresh store each time, so nothing is served from in-process caches
+            results.append(record(SUITE, "get_session_cold", params, measure(
+                lambda: _store(backend, f"history-{backend}-{size}").get_session(user_id, "session_9"),
+                max(5, iterations // 10))))
+
+        for threads in ((1, 4) if quick else (1, 4, 16)):
+            results.append(_concurrent_appends(backend, threads, 10 if quick else 50))
+    return results
+
+def _concurrent_appends(backend: str, threads: int, per_thread: int) -> Dict[str, Any]:
+    """Several threads appending to one user's session at once; every append must survive"""
+    store = _store(backend, f"history-{backend}-concurrent-{threads}")
+    user_id = "concurrent"
+    _seed(store, user_id, 1, 100)
+    durations = []
+    lock = threading.Lock()
+    start = threading.Barrier(threads)
+
+    def writer(t: int):
+        start.wait()
+        for i in range(per_thread):
+            started = time.perf_counter()
+            store.append_message(user_id, "session_0", _message(t * per_thread + i))
+            with lock:
+                durations.append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=writer, args=(t,)) for t in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    stored = len(store.get_session(user_id, "session_0")["messages"]) - 100
+    metrics = latency_metrics(durations, elapsed)
+    metrics["lost_updates"] = threads * per_thread - stored
+    return record(SUITE, "concurrent_append", {"backend": backend, "threads": threads, "appends_per_thread": per_thread}, metrics)
@@ -0,0 +1,78 @@
+"""
+Run the benchmark suites offline against a stub model and a throwaway data directory,
+writing machine-readable results that can be compared across commits. Run from backend/:
+
+    python -m benchmarks.run [--suite history ...] [--quick] [--output results.json] [--compare baseline.json]
+"""
+import sys
+import json
+import argparse
+import importlib
+
+from benchmarks.common import compare, prepare_environment, run_metadata
+
+SUITES = {
+    "history": "benchmarks.history_bench",
+    "storage": "benchmarks.storage_bench",
+    "conversion": "benchmarks.conversion_bench",
+    "chat": "benchmarks.chat_bench",
+    "auth": "benchmarks.auth_bench",
+}
+
+
+def run(suites, quick: bool = False, workdir: str = None) -> dict:
+    workdir = prepare_environment(workdir)
+    results = []
+    for name in suites:
+        # Imported only now: backend modules read their settings from the environment on import
+        module = importlib.import_module(SUITES[name])
+        print(f"running {name}...", file=sys.stderr)
+        results.extend(module.run_suite(quick))
+    return {"meta": {**run_metadata(), "quick": quick, "workdir": workdir}, "results": results}
+
+def print_results(results):
+    for row in results:
+        params = " ".join(f"{k}={v}" for k, v in row["params"].items())
+        if "skipped" in row:
+            print(f"{row['suite']:<11}skipped: {row['skipped']}")
+            continue
+        metrics = row["metrics"]
+        shown = ", ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}"
+                          for k, v in metrics.items() if k in ("p50_ms", "p95_ms", "p99_ms", "ops_per_sec", "mb_per_sec", "pages_per_sec",
+                                                               "dependency_us", "request_ms", "rejected", "errors", "lost_updates"))
+        print(f"{row['suite']:<11}{row['name']:<22}{params:<56}{shown}")
+
+def print_comparison(changes, show_all: bool = False):
+    for change in changes:
+        if change["verdict"] == "same" and not show_all:
+            continue
+        print(f"{change['verdict']:<7}{change['change'] * 100:>+8.1f}%  {change['key']} {change['metric']}: "
+              f"{change['before']:.3f} -> {change['after']:.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--suite", action="append", choices=sorted(SUITES), help="suite to run; repeatable, default all")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes and fewer iterations, for a smoke run")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change reported as faster/slower")
+    parser.add_argument("--workdir", help="data directory to use instead of a fresh temporary one")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    output = run(args.suite or list(SUITES), args.quick, args.workdir)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+    print_results(output["results"])
+    if baseline is not None:
+        print(f"\ncompared with {baseline['meta'].get('commit') or args.compare}:")
+        print_comparison(compare(baseline["results"], output["results"], args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Upload storage: streaming writes at several sizes, dedupe of re-uploads, reference bookkeeping"""
+import io
+import os
+from typing import Any, Dict, List
+
+from benchmarks.common import measure, record
+
+SUITE = "storage"
+
+
+def run_suite(quick: bool = False) -> List[Dict[str, Any]]:
+    from utils.file_storage import add_file_refs, release_file_refs, save_upload_stream
+
+    sizes = (64 * 1024, 1024 * 1024) if quick else (64 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+    iterations = 5 if quick else 20
+    results = []
+    for size in sizes:
+        params = {"bytes": size}
+        counter = iter(range(iterations + 1))
+
+        # Distinct content each call, so every write stores a new file
+        def fresh_upload():
+            body = os.urandom(size - 8) + next(counter).to_bytes(8, "big")
+            save_upload_stream(io.BytesIO(body), "storage-bench", "scan.png")
+
+        metrics = measure(fresh_upload, iterations, warmup=0)
+        metrics["mb_per_sec"] = size / (1024 * 1024) / (metrics["mean_ms"] / 1000)
+        results.append(record(SUITE, "save_upload", params, metrics))
+
+        # Same content again: hashed, then dropped in favour of the stored copy
+        body = os.urandom(size)
+        save_upload_stream(io.BytesIO(body), "storage-bench", "scan.png")
+        metrics = measure(lambda: save_upload_stream(io.BytesIO(body), "storage-bench", "scan.png"), iterations)
+        metrics["mb_per_sec"] = size / (1024 * 1024) / (metrics["mean_ms"] / 1000)
+        results.append(record(SUITE, "save_duplicate_upload", params, metrics))
+
+    path = save_upload_stream(io.BytesIO(b"referenced"), "storage-bench", "note.png")
+    results.append(record(SUITE, "add_release_refs", {}, measure(
+        lambda: (add_file_refs("storage-bench", [path]), release_file_refs("storage-bench", [path])), iterations * 20)))
+    return results
@@ -1,10 +1,30 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
-from routers import auth, chat, chat_history, oauth2
+from routers import auth, chat, chat_history, file_preview, model_api, oauth2
+from utils.answer_cache import answer_cache
+from utils.conversion import ConversionQueueFull, conversion_service
+from utils.inference_executor import inference_executor
+from utils.kv_cache import session_kv_cache
+from utils.metrics import MetricsMiddleware, register_cache_stats, register_queue_depths, registry
+from utils.render_cache import render_cache
+from utils.security import token_cache
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.staticfiles import StaticFiles
 
-app = FastAPI(title="OpenHealth-Inspired AI Health Assistant")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the model in the background so non-model routes serve immediately
+    if model_api.MODEL_PRELOAD:
+        model_api.start_model_loading()
+    chat_history.upload_sweeper.start()
+    yield
+    chat_history.upload_sweeper.stop()
+    conversion_service.shutdown()
+
+app = FastAPI(title="OpenHealth-Inspired AI Health Assistant", lifespan=lifespan)
 
 app.add_middleware(
     SessionMiddleware,
@@ -17,8 +37,20 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[chat_history.NEXT_CURSOR_HEADER],
 )
 
+# Added last so it wraps the others: request timings include every other middleware
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(ConversionQueueFull)
+async def conversion_queue_full(request, exc):
+    return JSONResponse(
+        {"detail": "Document conversion queue is full, please retry shortly."},
+        status_code=503,
+        headers={"Retry-After": "1"}
+    )
+
 # Serve uploaded files
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
@@ -26,3 +58,40 @@ app.include_router(auth.router, prefix="/auth")
 app.include_router(oauth2.router, prefix="/auth/oauth2")
 app.include_router(chat.router, prefix="/chat")
 app.include_router(chat_history.router, prefix="/chat")
+app.include_router(file_preview.router, prefix="/files")
+
+@app.get("/ready")
+def readiness():
+    """Readiness probe: 200 once the model is loaded, 503 while loading or after a failed load"""
+    status = model_api.model_status()
+    return JSONResponse(status, status_code=200 if model_api.is_model_ready() else 503)
+
+def cache_stats():
+    return {
+        "answers": answer_cache.stats(),
+        **model_api.backend.stats(),
+        "kv": session_kv_cache.stats(),
+        "renders": render_cache.stats(),
+        "history": chat_history.history_store.cache_stats(),
+        "auth": token_cache.stats(),
+    }
+
+def queue_depths():
+    return {
+        "inference": inference_executor.in_flight(),
+        "batcher": model_api.batcher.pending(),
+        "conversion": conversion_service.pending(),
+    }
+
+register_cache_stats(cache_stats)
+register_queue_depths(queue_depths)
+
+@app.get("/stats")
+def stats():
+    """Size and hit-rate counters of the in-process caches, queue depths and upload sweep counters"""
+    return {**cache_stats(), "queues": queue_depths(), "upload_gc": chat_history.upload_sweeper.stats()}
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus scrape endpoint: route and stage latency histograms, token throughput, queue depths and cache hit rates"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
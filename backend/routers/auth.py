@@ -1,23 +1,9 @@
-import os
-from jose import JWTError, jwt
-from fastapi.security import OAuth2PasswordBearer
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends
 
-SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
-ALGORITHM = os.getenv("ALGORITHM", "HS256")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+from utils.security import get_token_claims
 
 router = APIRouter()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/oauth2/login/google")
-
 @router.get("/me")
-def read_users_me(token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return {"username": username, "name": payload.get("name", ""), "provider": payload.get("provider", "oauth2")}
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
\ No newline at end of file
+def read_users_me(payload: dict = Depends(get_token_claims)):
+    return {"username": payload["sub"], "name": payload.get("name", ""), "provider": payload.get("provider", "oauth2")}
@@ -1,48 +1,258 @@
 import io
+import json
+import asyncio
+from functools import partial
 from PIL import Image
-from pdf2image import convert_from_bytes
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
-from routers.model_api import run_vlm
-from routers.chat_history import get_user_id
-from utils.file_storage import save_uploaded_file
+from routers.model_api import (
+    check_inference_capacity, image_input_size, queue_full_error, run_inference, run_vlm, run_vlm_chat, run_vlm_many, stream_vlm,
+)
+from routers.chat_history import history_store
+from utils.conversation import context_window, history_turns
+from utils.file_storage import MAX_UPLOAD_BYTES, UploadTooLarge, discard_upload, save_upload_stream
+from utils.document_qa import answer_document
+from utils.generation_profiles import DEFAULT_PROFILE, PROFILE_PATTERN, PROFILES
+from utils.inference_executor import InferenceQueueFull, inference_executor
+from utils.conversion import ConversionQueueFull, conversion_service
+from utils.pdf_render import PDF_RENDER_MAX_SIDE, pdf_page_count
+from utils.render_cache import render_cache
+from utils.security import get_user_id
 
 
 router = APIRouter()
 
-@router.post("/ask")
-def chat_ask(file: UploadFile = File(None), question: str = Form(...), user_id: str = Depends(get_user_id)):
-    images = []
-    file_path = None
-    original_filename = None
+def store_upload(file: UploadFile, user_id: str) -> str:
+    """Validate an uploaded PDF or image and stream it to storage, returning the stored file path"""
+    content_type = file.content_type or ""
+    if content_type != "application/pdf" and not content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Unsupported file type. Please upload a PDF or image.")
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large.")
+    if content_type == "application/pdf" and conversion_service.is_full():
+        raise ConversionQueueFull("Conversion queue is full")
 
-    if file:
-        original_filename = file.filename
-        content_type = file.content_type
+    # Stream the upload to storage, then work from the stored copy instead of holding the bytes in memory
+    try:
+        return save_upload_stream(file.file, user_id, file.filename)
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="File too large.")
 
-        # Read file content for storage
-        file_content = file.file.read()
-        file.file.seek(0)  # Reset file pointer for processing
+def process_upload(file: UploadFile, user_id: str, page: int = 1):
+    """
+    Store an uploaded PDF or image and return (images, file_path, original_filename).
+    For PDFs only the requested 1-based ``page`` is rasterized, at the model's input resolution,
+    through the render cache so asking about the same page again does not re-render it.
+    """
+    original_filename = file.filename
+    content_type = file.content_type or ""
+    file_path = store_upload(file, user_id)
 
+    try:
         if content_type == "application/pdf":
-            images = convert_from_bytes(file_content)
-            if not images:
+            page_count = pdf_page_count(file_path)
+            if not page_count:
                 raise HTTPException(status_code=400, detail="No images found in PDF.")
-        elif content_type.startswith("image/"):
-            images = [Image.open(io.BytesIO(file_content))]
+            if page > page_count:
+                raise HTTPException(status_code=400, detail=f"PDF has only {page_count} pages.")
+            rendered = render_cache.get(file_path, page, max_side=PDF_RENDER_MAX_SIDE or image_input_size())
+            images = [Image.open(io.BytesIO(rendered))]
         else:
-            raise HTTPException(status_code=400, detail="Unsupported file type. Please upload a PDF or image.")
+            images = [Image.open(file_path)]
+    except Exception:
+        discard_upload(user_id, file_path)
+        raise
+
+    render_cache.prewarm(file_path)
+
+    return images, file_path, original_filename
+
+def session_context(user_id: str, session_id: str):
+    """Earlier turns of a chat session as model context, plus the key of its KV cache"""
+    count = history_store.count_messages(user_id, session_id)
+    if count is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    window = context_window(count)
+    result = history_store.page_messages(user_id, session_id, window) if window else ([], None)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return history_turns(result[0]), (user_id, session_id)
+
+def sse_event(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-        # Save the original file
-        file_path = save_uploaded_file(file_content, user_id, original_filename)
+@router.post("/ask")
+async def chat_ask(
+    file: UploadFile = File(None),
+    question: str = Form(...),
+    page: int = Form(1, ge=1),
+    session_id: str = Form(None),
+    profile: str = Form(DEFAULT_PROFILE.name, pattern=PROFILE_PATTERN),
+    user_id: str = Depends(get_user_id)
+):
+    """
+    With ``session_id`` the session's earlier messages are given to the model as conversation context.
+    ``profile`` selects the generation profile (answer length, stop sequences and deadline).
+    """
+    check_inference_capacity()
+
+    images = []
+    file_path = None
+    original_filename = None
+    history, session_key = (), None
 
-    if not images:
-        answer = run_vlm(query=question)
-    else:
-        answer = run_vlm(images[0], question)
+    if session_id:
+        history, session_key = await run_in_threadpool(session_context, user_id, session_id)
+
+    if file:
+        images, file_path, original_filename = await run_in_threadpool(process_upload, file, user_id, page)
+    image = images[0] if images else None
+
+    try:
+        if session_id:
+            answer = await run_inference(run_vlm_chat, image, question, history, session_key, PROFILES[profile])
+        else:
+            answer = await run_inference(run_vlm, image, question, PROFILES[profile])
+    except BaseException:
+        # Including cancellation by a client disconnect: no message will reference the upload
+        if file_path:
+            discard_upload(user_id, file_path)
+        raise
 
     return {
         "result": answer,
         "filePath": file_path,
         "fileName": original_filename
     }
+
+@router.post("/ask/stream")
+async def chat_ask_stream(
+    file: UploadFile = File(None),
+    question: str = Form(...),
+    page: int = Form(1, ge=1),
+    session_id: str = Form(None),
+    profile: str = Form(DEFAULT_PROFILE.name, pattern=PROFILE_PATTERN),
+    user_id: str = Depends(get_user_id)
+):
+    """
+    Server-sent events variant of /ask. Emits one "token" event per generated text chunk,
+    then a final "result" event carrying the same result/filePath/fileName payload as /ask.
+    """
+    check_inference_capacity()
+
+    images = []
+    file_path = None
+    original_filename = None
+    history, session_key = (), None
+
+    if session_id:
+        history, session_key = await run_in_threadpool(session_context, user_id, session_id)
+
+    if file:
+        images, file_path, original_filename = await run_in_threadpool(process_upload, file, user_id, page)
+
+    try:
+        tokens = stream_vlm(images[0] if images else None, question, history, session_key, PROFILES[profile])
+    except InferenceQueueFull:
+        if file_path:
+            discard_upload(user_id, file_path)
+        raise queue_full_error()
+
+    async def event_stream():
+        chunks = []
+        answered = False
+        try:
+            async for text in tokens:
+                chunks.append(text)
+                yield sse_event({"token": text}, event="token")
+            answered = True
+        except Exception as exc:
+            yield sse_event({"detail": str(exc)}, event="error")
+            return
+        finally:
+            # Failed, or cancelled by the client going away
+            if not answered and file_path:
+                discard_upload(user_id, file_path)
+        yield sse_event({
+            # Same answer /ask returns: token events may already have carried the stop string
+            "result": PROFILES[profile].trim("".join(chunks)),
+            "filePath": file_path,
+            "fileName": original_filename
+        }, event="result")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/ask/document")
+async def chat_ask_document(
+    file: UploadFile = File(...),
+    question: str = Form(...),
+    profile: str = Form(DEFAULT_PROFILE.name, pattern=PROFILE_PATTERN),
+    user_id: str = Depends(get_user_id)
+):
+    """
+    Answer a question over every page of a PDF (up to DOC_QA_MAX_PAGES) rather than just one.
+    Streams server-sent "progress" events ({stage, done, total}) while pages are read, then a
+    "result" event with result/filePath/fileName plus the pages that contributed to the answer.
+    """
+    check_inference_capacity()
+    if file.content_type != "application/pdf":
+        raise HTTPException(status_code=400, detail="Unsupported file type. Please upload a PDF.")
+
+    file_path = await run_in_threadpool(store_upload, file, user_id)
+    original_filename = file.filename
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def progress(stage: str, done: int, total: int):
+        loop.call_soon_threadsafe(events.put_nowait, {"stage": stage, "done": done, "total": total})
+
+    try:
+        job = inference_executor.submit(
+            answer_document, file_path, question, partial(run_vlm_many, profile=PROFILES[profile]),
+            max_side=PDF_RENDER_MAX_SIDE or image_input_size(), progress=progress
+        )
+    except InferenceQueueFull:
+        discard_upload(user_id, file_path)
+        raise queue_full_error()
+    job.add_done_callback(lambda _: loop.call_soon_threadsafe(events.put_nowait, None))
+    # Thumbnail render waits for the pages so it does not take a conversion slot from them
+    job.add_done_callback(lambda _: render_cache.prewarm(file_path))
+
+    async def event_stream():
+        answered = False
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield sse_event(event, event="progress")
+            try:
+                outcome = job.result()
+            except Exception as exc:
+                yield sse_event({"detail": str(exc)}, event="error")
+                return
+            answered = True
+            yield sse_event({
+                **outcome,
+                "filePath": file_path,
+                "fileName": original_filename
+            }, event="result")
+        finally:
+            # Failed, or cancelled by the client going away; a job still reading the pages
+            # gives the upload back once it is done with them
+            if not answered:
+                job.add_done_callback(lambda _: discard_upload(user_id, file_path))
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
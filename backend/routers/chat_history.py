@@ -1,22 +1,25 @@
-import os
-import json
 from datetime import datetime
 from typing import List, Dict, Any, Optional
 
-from jose import JWTError, jwt
 from pydantic import BaseModel
-from fastapi.security import OAuth2PasswordBearer
-from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Response, Query
 
-router = APIRouter()
+from utils.file_storage import add_file_refs, release_file_refs
+from utils.history_store import InvalidCursor, create_history_store
+from utils.kv_cache import session_kv_cache
+from utils.security import get_user_id
+from utils.upload_gc import OrphanSweeper, message_file_paths
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/oauth2/login/google")
+router = APIRouter()
 
-SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
-ALGORITHM = os.getenv("ALGORITHM", "HS256")
+# Backend selected with CHAT_HISTORY_BACKEND ("json" or "sqlite")
+history_store = create_history_store()
+# Background reconciliation of the upload index with stored messages, started by the app
+upload_sweeper = OrphanSweeper(history_store)
 
-CHAT_HISTORY_DIR = "chat_history_db"
-os.makedirs(CHAT_HISTORY_DIR, exist_ok=True)
+# Paginated listings return the cursor of the next (older) page in this header
+NEXT_CURSOR_HEADER = "X-Next-Before"
+MAX_PAGE_SIZE = 200
 
 class ChatMessage(BaseModel):
     sender: str
@@ -24,6 +27,8 @@ class ChatMessage(BaseModel):
     fileName: Optional[str] = None
     filePath: Optional[str] = None
     timestamp: Optional[str] = None
+    # A failure notice in place of an answer; kept for display, never replayed as context
+    error: Optional[bool] = None
 
 class ChatSession(BaseModel):
     id: str
@@ -31,61 +36,58 @@ class ChatSession(BaseModel):
     created_at: str
     messages: List[ChatMessage]
 
-def get_user_id(token: str = Depends(oauth2_scheme)) -> str:
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return username
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-def get_history_path(user_id: str) -> str:
-    return os.path.join(CHAT_HISTORY_DIR, f"{user_id}.json")
-
-def load_sessions(user_id: str) -> List[Dict[str, Any]]:
-    path = get_history_path(user_id)
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
-
-def save_sessions(user_id: str, sessions: List[Dict[str, Any]]):
-    path = get_history_path(user_id)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(sessions, f, ensure_ascii=False, indent=2)
-
-def get_session_by_id(user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
-    sessions = load_sessions(user_id)
-    for session in sessions:
-        if session["id"] == session_id:
-            return session
-    return None
+def set_next_cursor(response: Response, next_before: Optional[str]):
+    if next_before is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_before
 
 @router.get("/sessions", response_model=List[Dict[str, Any]])
-def get_chat_sessions(user_id: str = Depends(get_user_id)):
-    sessions = load_sessions(user_id)
-    return [
-        {
-            "id": session["id"],
-            "title": session["title"],
-            "created_at": session["created_at"]
-        }
-        for session in sessions
-    ]
+def get_chat_sessions(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    user_id: str = Depends(get_user_id)
+):
+    """
+    Session summaries, oldest first. With ``limit`` only the most recent page is returned;
+    pass the X-Next-Before header value as ``before`` to fetch the page before it.
+    """
+    if limit is None and before is None:
+        return history_store.list_sessions(user_id)
+    try:
+        sessions, next_before = history_store.page_sessions(user_id, limit or MAX_PAGE_SIZE, before)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    set_next_cursor(response, next_before)
+    return sessions
 
 @router.get("/sessions/{session_id}", response_model=Dict[str, Any])
 def get_chat_session(session_id: str, user_id: str = Depends(get_user_id)):
-    session = get_session_by_id(user_id, session_id)
+    session = history_store.get_session(user_id, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     return session
 
+@router.get("/sessions/{session_id}/messages", response_model=List[Dict[str, Any]])
+def get_chat_session_messages(
+    session_id: str,
+    response: Response,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    user_id: str = Depends(get_user_id)
+):
+    """Latest ``limit`` messages of a session, oldest first, paged backwards with ``before``"""
+    try:
+        result = history_store.page_messages(user_id, session_id, limit, before)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    messages, next_before = result
+    set_next_cursor(response, next_before)
+    return messages
+
 @router.post("/sessions")
 def create_chat_session(session_data: Dict[str, str], user_id: str = Depends(get_user_id)):
-    sessions = load_sessions(user_id)
-
     new_session = {
         "id": f"session_{datetime.utcnow().timestamp()}",
         "title": session_data.get("title", "New Chat"),
@@ -93,88 +95,52 @@ def create_chat_session(session_data: Dict[str, str], user_id: str = Depends(get
         "messages": []
     }
 
-    sessions.append(new_session)
-    save_sessions(user_id, sessions)
+    history_store.create_session(user_id, new_session)
     return {"session_id": new_session["id"]}
 
 @router.post("/sessions/{session_id}/messages")
 def add_message_to_session(session_id: str, message: ChatMessage, user_id: str = Depends(get_user_id)):
-    sessions = load_sessions(user_id)
-
-    session_index = -1
-    for i, session in enumerate(sessions):
-        if session["id"] == session_id:
-            session_index = i
-            break
-
-    if session_index == -1:
-        raise HTTPException(status_code=404, detail="Session not found")
-
     if not message.timestamp:
         message.timestamp = datetime.utcnow().isoformat()
 
-    sessions[session_index]["messages"].append(message.dict())
-    save_sessions(user_id, sessions)
+    stored = message.dict()
+    # The history write and its upload index update happen together under the user lock
+    with history_store.user_lock(user_id):
+        if not history_store.append_message(user_id, session_id, stored):
+            raise HTTPException(status_code=404, detail="Session not found")
+        add_file_refs(user_id, message_file_paths([stored]))
 
     return {"status": "ok"}
 
 @router.get("/history", response_model=List[Dict[str, Any]])
-def get_chat_history_legacy(user_id: str = Depends(get_user_id)):
-    sessions = load_sessions(user_id)
-    all_messages = []
-    for session in sessions:
-        for message in session.get("messages", []):
-            all_messages.append(message)
-    return all_messages
+def get_chat_history_legacy(limit: Optional[int] = Query(None, ge=1), user_id: str = Depends(get_user_id)):
+    return history_store.list_messages(user_id, limit)
 
 @router.post("/history")
 def add_chat_message_legacy(message: Dict[str, Any], user_id: str = Depends(get_user_id)):
-    sessions = load_sessions(user_id)
-
-    if not sessions:
-        new_session = {
-            "id": f"session_{datetime.utcnow().timestamp()}",
-            "title": "Legacy Chat",
-            "created_at": datetime.utcnow().isoformat(),
-            "messages": []
-        }
-        sessions.append(new_session)
+    new_session = {
+        "id": f"session_{datetime.utcnow().timestamp()}",
+        "title": "Legacy Chat",
+        "created_at": datetime.utcnow().isoformat(),
+        "messages": []
+    }
 
     message["timestamp"] = datetime.utcnow().isoformat()
-    sessions[-1]["messages"].append(message)
-    save_sessions(user_id, sessions)
+    with history_store.user_lock(user_id):
+        history_store.append_message_to_latest(user_id, message, new_session)
+        add_file_refs(user_id, message_file_paths([message]))
 
     return {"status": "ok"}
 
 @router.delete("/sessions/{session_id}")
 def delete_chat_session(session_id: str, user_id: str = Depends(get_user_id)):
-    from utils.file_storage import cleanup_user_files
-
-    sessions = load_sessions(user_id)
-
-    session_index = -1
-    session_to_delete = None
-    for i, session in enumerate(sessions):
-        if session["id"] == session_id:
-            session_index = i
-            session_to_delete = session
-            break
-
-    if session_index == -1:
-        raise HTTPException(status_code=404, detail="Session not found")
-
-    # Collect file paths to keep (from other sessions)
-    files_to_keep = []
-    for session in sessions:
-        if session["id"] != session_id:
-            for message in session.get("messages", []):
-                if message.get("filePath"):
-                    files_to_keep.append(message["filePath"])
-
-    # Cleanup unused files
-    deleted_count = cleanup_user_files(user_id, files_to_keep)
-
-    del sessions[session_index]
-    save_sessions(user_id, sessions)
+    with history_store.user_lock(user_id):
+        deleted = history_store.delete_session(user_id, session_id)
+        if deleted is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        # Only this session's files are touched: each loses one reference per message, and
+        # is deleted once no message of any session references it
+        deleted_count = release_file_refs(user_id, message_file_paths(deleted.get("messages", [])))
+    session_kv_cache.drop((user_id, session_id))
 
     return {"status": "ok", "files_deleted": deleted_count}
@@ -0,0 +1,42 @@
+import os
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+
+from utils.file_storage import USERS_DIR, file_content_hash
+from utils.pdf_render import IMAGE_FORMATS
+from utils.render_cache import RENDITIONS, render_cache
+from utils.security import get_user_id
+
+router = APIRouter()
+
+@router.get("/{filename}/preview")
+def get_file_preview(
+    filename: str,
+    page: int = Query(1, ge=1),
+    size: str = Query("thumbnail", pattern=f"^({'|'.join(RENDITIONS)})$"),
+    if_none_match: str = Header(None),
+    user_id: str = Depends(get_user_id),
+):
+    """
+    Cached rendition of one of the user's stored uploads: a page of a PDF or the image itself,
+    as a ``thumbnail`` or a full ``page`` preview. Renders are served from the render cache
+    and only rendered here on a miss.
+    """
+    if os.path.basename(filename) != filename or filename.startswith("."):
+        raise HTTPException(status_code=404, detail="File not found")
+    file_path = os.path.join(USERS_DIR, user_id, filename)
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # Uploads are content-addressed, so a rendition never changes
+    etag = f'"{file_content_hash(file_path)}-{size}-{page}"'
+    headers = {"Cache-Control": "private, max-age=31536000, immutable", "ETag": etag}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        data = render_cache.get_rendition(file_path, size, page)
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f"Page {page} not found")
+
+    media_type = IMAGE_FORMATS[RENDITIONS[size][1]][1]
+    return Response(content=data, media_type=media_type, headers=headers)
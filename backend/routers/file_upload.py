@@ -1,47 +1,82 @@
-import io
-import base64
-from PIL import Image
-from pdf2image import convert_from_bytes
-from fastapi import APIRouter, UploadFile, File, Depends
+from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException
 
-from routers.chat_history import get_user_id
-from utils.file_storage import save_uploaded_file
+from utils.file_storage import MAX_UPLOAD_BYTES, UploadTooLarge, discard_upload, save_upload_stream
+from utils.conversion import (
+    ConversionQueueFull, conversion_service, image_to_base64, image_to_bytes, iter_pdf_pages_base64, iter_pdf_pages_bytes,
+)
+from utils.page_delivery import IMAGE_FORMAT_PATTERN, RESPONSE_MODE_PATTERN, page_stream_response
+from utils.pdf_render import IMAGE_QUALITY
+from utils.security import get_user_id
 
 router = APIRouter()
 
+# Stored file path for streamed responses, where there is no JSON body to carry it
+FILE_PATH_HEADER = "X-File-Path"
+
+def _converted_pages(file_path: str, is_pdf: bool, binary: bool, image_format: str, quality: int):
+    if is_pdf:
+        if binary:
+            yield from iter_pdf_pages_bytes(file_path, image_format=image_format, quality=quality)
+        else:
+            yield from iter_pdf_pages_base64(file_path, image_format=image_format, quality=quality)
+    else:
+        convert = image_to_bytes if binary else image_to_base64
+        yield convert(file_path, image_format, quality)
+
+def _release_on_error(pages, user_id: str, file_path: str):
+    # A stream that fails part way drops the stored file, as the JSON response does
+    try:
+        yield from pages
+    except Exception:
+        discard_upload(user_id, file_path)
+        raise
+
 @router.post("/")
-def upload_file(file: UploadFile = File(...), user_id: str = Depends(get_user_id)):
+def upload_file(
+    file: UploadFile = File(...),
+    response_mode: str = Form("json", pattern=RESPONSE_MODE_PATTERN),
+    image_format: str = Form("png", pattern=IMAGE_FORMAT_PATTERN),
+    quality: int = Form(IMAGE_QUALITY, ge=1, le=100),
+    user_id: str = Depends(get_user_id),
+):
     """
-    Accepts a PDF or image file upload. If PDF, converts each page to a PNG image. If image, returns the image as base64 PNG.
+    Accepts a PDF or image file upload. If PDF, converts each page to an image. If image, re-encodes it.
     Also saves the original file to storage.
-    Returns a list of base64-encoded PNG images for further processing by VLM models, plus file storage info.
+    By default returns a list of base64-encoded PNG images for further processing by VLM models, plus file storage info.
+    ``response_mode`` ndjson or multipart streams pages as they convert instead, with the stored path in
+    the X-File-Path header; ``image_format`` (png, webp, jpeg) and ``quality`` choose the encoding.
     """
-    content_type = file.content_type
+    content_type = file.content_type or ""
     original_filename = file.filename
     result_images = []
 
-    # Read file content for storage and processing
-    file_content = file.file.read()
-    file.file.seek(0)  # Reset file pointer for image processing
-
-    if content_type == "application/pdf":
-        images = convert_from_bytes(file_content)
-        for img in images:
-            buf = io.BytesIO()
-            img.save(buf, format="PNG")
-            base64_str = base64.b64encode(buf.getvalue()).decode("utf-8")
-            result_images.append(base64_str)
-    elif content_type.startswith("image/"):
-        img = Image.open(io.BytesIO(file_content))
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        base64_str = base64.b64encode(buf.getvalue()).decode("utf-8")
-        result_images.append(base64_str)
-    else:
+    if content_type != "application/pdf" and not content_type.startswith("image/"):
         return {"error": "Unsupported file type. Please upload a PDF or image."}
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large.")
+    if conversion_service.is_full():
+        raise ConversionQueueFull("Conversion queue is full")
+
+    # Stream the original file to storage and convert from the stored copy
+    try:
+        file_path = save_upload_stream(file.file, user_id, original_filename)
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="File too large.")
+
+    # Rendering and image/base64 encoding run on the conversion process pool
+    is_pdf = content_type == "application/pdf"
+    if response_mode != "json":
+        pages = _converted_pages(file_path, is_pdf, response_mode == "multipart", image_format, quality)
+        return page_stream_response(
+            _release_on_error(pages, user_id, file_path), response_mode, image_format,
+            headers={FILE_PATH_HEADER: file_path},
+        )
 
-    # Save the original file
-    file_path = save_uploaded_file(file_content, user_id, original_filename)
+    try:
+        result_images.extend(_converted_pages(file_path, is_pdf, False, image_format, quality))
+    except Exception:
+        discard_upload(user_id, file_path)
+        raise
 
     return {
         "images": result_images,
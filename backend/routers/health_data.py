@@ -1,8 +1,12 @@
-import io
-import base64
+import os
+import tempfile
 from typing import List
-from pdf2image import convert_from_bytes
-from fastapi import APIRouter, UploadFile, File
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+
+from utils.file_storage import MAX_UPLOAD_BYTES, UploadTooLarge, copy_stream
+from utils.conversion import ConversionQueueFull, conversion_service, iter_pdf_pages_base64, iter_pdf_pages_bytes
+from utils.page_delivery import IMAGE_FORMAT_PATTERN, RESPONSE_MODE_PATTERN, page_stream_response
+from utils.pdf_render import IMAGE_QUALITY
 
 router = APIRouter()
 
@@ -11,17 +15,46 @@ router = APIRouter()
 def get_health_data():
     return {"msg": "Health data endpoint (stub)"}
 
+def _spooled_pages(pdf_path: str, binary: bool, image_format: str, quality: int):
+    # Owns the temporary PDF: removed once the pages are consumed, or the stream fails or is abandoned
+    try:
+        if binary:
+            yield from iter_pdf_pages_bytes(pdf_path, image_format=image_format, quality=quality)
+        else:
+            yield from iter_pdf_pages_base64(pdf_path, image_format=image_format, quality=quality)
+    finally:
+        os.remove(pdf_path)
+
 @router.post("/pdf-to-images", response_model=List[str])
-def pdf_to_images(file: UploadFile = File(...)):
+def pdf_to_images(
+    file: UploadFile = File(...),
+    response_mode: str = Form("json", pattern=RESPONSE_MODE_PATTERN),
+    image_format: str = Form("png", pattern=IMAGE_FORMAT_PATTERN),
+    quality: int = Form(IMAGE_QUALITY, ge=1, le=100),
+):
     """
-    Accepts a PDF file upload, converts each page to a PNG image, and returns a list of base64-encoded images.
+    Accepts a PDF file upload, converts each page to an image, and returns a list of base64-encoded images.
+    ``response_mode`` ndjson or multipart streams the pages as they convert instead;
+    ``image_format`` (png, webp, jpeg) and ``quality`` choose the encoding.
     """
-    pdf_bytes = file.file.read()
-    images = convert_from_bytes(pdf_bytes)
-    base64_images = []
-    for img in images:
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        base64_str = base64.b64encode(buf.getvalue()).decode("utf-8")
-        base64_images.append(base64_str)
-    return base64_images
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large.")
+    if conversion_service.is_full():
+        raise ConversionQueueFull("Conversion queue is full")
+
+    # Nothing is stored for this endpoint, so spool the upload to a temporary file and render page by page
+    pdf_file = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+    try:
+        with pdf_file:
+            copy_stream(file.file, pdf_file)
+    except UploadTooLarge:
+        os.remove(pdf_file.name)
+        raise HTTPException(status_code=413, detail="File too large.")
+    except Exception:
+        os.remove(pdf_file.name)
+        raise
+
+    pages = _spooled_pages(pdf_file.name, response_mode == "multipart", image_format, quality)
+    if response_mode != "json":
+        return page_stream_response(pages, response_mode, image_format)
+    return list(pages)
@@ -1,50 +1,234 @@
 import os
 import io
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
 from PIL import Image
 from dotenv import load_dotenv
-from fastapi import APIRouter, UploadFile, File, Form
-
-import torch
-from transformers import AutoProcessor, AutoModelForImageTextToText
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 
+# Before the utils imports below, which read their settings from the environment
 load_dotenv()
 access_token = os.getenv("HF_TOKEN")
 
+from utils.answer_cache import answer_cache, answer_key, image_hash
+from utils.batching import BatchScheduler
+from utils.generation_profiles import DEFAULT_PROFILE, PROFILE_PATTERN, PROFILES, GenerationProfile
+from utils.inference_backends import BatchRequest, create_backend
+from utils.inference_executor import InferenceQueueFull, inference_executor
+from utils.metrics import timed
+
 router = APIRouter()
 
-model_id = "google/medgemma-4b-it"
-model = AutoModelForImageTextToText.from_pretrained(
-    model_id,
-    torch_dtype=torch.bfloat16,
-    device_map="auto",
-)
-processor = AutoProcessor.from_pretrained(model_id)
-
-def run_vlm(image: Image.Image = None, query: str = "") -> str:
-    user_content = [{"type": "text", "text": query}]
-    if image:
-        user_content.append({"type": "image", "image": image})
-
-    messages = [
-        {"role": "system", "content": [{"type": "text", "text": "You are an expert radiologist."}]},
-        {"role": "user", "content": user_content}
-    ]
-    inputs = processor.apply_chat_template(
-        messages, add_generation_prompt=True, tokenize=True,
-        return_dict=True, return_tensors="pt"
-    ).to(model.device, dtype=torch.bfloat16)
-    input_len = inputs["input_ids"].shape[-1]
-    with torch.inference_mode():
-        generation = model.generate(**inputs, max_new_tokens=200, do_sample=False)
-        generation = generation[0][input_len:]
-    decoded = processor.decode(generation, skip_special_tokens=True)
-    return decoded
+# Selected by INFERENCE_BACKEND, see utils.inference_backends
+backend = create_backend()
+model_id = backend.model_id
+
+MODEL_PRELOAD = os.getenv("MODEL_PRELOAD", "true").lower() in ("1", "true", "yes")
+VLM_MAX_BATCH_SIZE = int(os.getenv("VLM_MAX_BATCH_SIZE", "8"))
+VLM_BATCH_WINDOW_MS = float(os.getenv("VLM_BATCH_WINDOW_MS", "10"))
+
+# The lock only guards _model_state; backend.load() runs outside it so that
+# ensure_model_ready(), called on the event loop, never waits for a load
+_model_lock = threading.Lock()
+_model_loaded = threading.Event()
+_model_state = {"status": "not_loaded", "error": None}
+
+def _claim_load() -> bool:
+    """Mark the model as loading; False if it is already loading or loaded"""
+    with _model_lock:
+        if _model_state["status"] in ("loading", "ready"):
+            return False
+        _model_state.update(status="loading", error=None)
+        _model_loaded.clear()
+        return True
+
+def _load():
+    try:
+        backend.load()
+    except Exception as exc:
+        with _model_lock:
+            _model_state.update(status="failed", error=str(exc))
+        raise
+    else:
+        with _model_lock:
+            _model_state["status"] = "ready"
+    finally:
+        _model_loaded.set()
+
+def load_model():
+    """Load the backend once; concurrent callers wait for the load in progress"""
+    if _claim_load():
+        _load()
+        return
+    _model_loaded.wait()
+    if _model_state["status"] == "failed":
+        raise RuntimeError(f"Model failed to load: {_model_state['error']}")
+
+def start_model_loading() -> bool:
+    """Start loading the model in a background thread unless it is already loading or loaded"""
+    if not _claim_load():
+        return False
+    threading.Thread(target=_load_model_quietly, name="model-loader", daemon=True).start()
+    return True
+
+def _load_model_quietly():
+    try:
+        _load()
+    except Exception:
+        pass  # Failure is recorded in _model_state and reported by model_status()
+
+def model_status() -> Dict[str, Any]:
+    return {"model_id": model_id, "backend": backend.name, **_model_state}
+
+def is_model_ready() -> bool:
+    return _model_state["status"] == "ready"
+
+def image_input_size(default: int = 896) -> int:
+    """Longest side, in pixels, of the images the model looks at"""
+    return backend.image_input_size(default)
+
+def ensure_model_ready():
+    """Raise 503 while the model is still loading, kicking off the load if nobody has yet"""
+    if is_model_ready():
+        return
+    start_model_loading()
+    status = _model_state["status"]
+    detail = "Model failed to load." if status == "failed" else "Model is loading, please retry shortly."
+    raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "10"})
+
+def _run_vlm_batch(requests: List[Tuple[BatchRequest, GenerationProfile]]) -> List[Tuple[str, bool]]:
+    # Each generation profile runs with its own settings
+    results = [None] * len(requests)
+    groups = {}
+    for i, (_, profile) in enumerate(requests):
+        groups.setdefault(profile, []).append(i)
+    for profile, indices in groups.items():
+        with timed("generate_batch"):
+            answers = backend.generate_batch([requests[i][0] for i in indices], profile)
+        for i, result in zip(indices, answers):
+            results[i] = result
+    return results
+
+batcher = BatchScheduler(_run_vlm_batch, max_batch_size=VLM_MAX_BATCH_SIZE, max_wait_ms=VLM_BATCH_WINDOW_MS)
+
+def cache_key(image: Image.Image = None, query: str = "", history: Sequence[Dict[str, str]] = (),
+              profile: GenerationProfile = DEFAULT_PROFILE) -> str:
+    # Backends and quantization modes answer differently, so they never share entries
+    settings = {"model_id": model_id, "backend": backend.name, "quantization": backend.quantization, **profile.cache_settings()}
+    return answer_key(profile.system_prompt, query, image_hash(image), settings, history)
+
+def run_vlm(image: Image.Image = None, query: str = "", profile: GenerationProfile = DEFAULT_PROFILE) -> str:
+    return run_vlm_many([(image, query)], profile)[0]
+
+def run_vlm_many(requests: Sequence[Tuple[Optional[Image.Image], str]], profile: GenerationProfile = DEFAULT_PROFILE) -> List[str]:
+    """
+    Answer several (image, query) requests, serving repeats from the answer cache and
+    queueing the rest at once so they can share a batch
+    """
+    keys = [cache_key(image, query, profile=profile) for image, query in requests]
+    results = [answer_cache.get(key) for key in keys]
+    futures = {i: batcher.submit(((*requests[i], (), None), profile)) for i, answer in enumerate(results) if answer is None}
+    for i, future in futures.items():
+        results[i], complete = future.result()
+        if complete:
+            answer_cache.put(keys[i], results[i])
+    return results
+
+def run_vlm_chat(image: Image.Image = None, query: str = "", history: Sequence[Dict[str, str]] = (),
+                 session_key: Optional[Tuple[str, str]] = None, profile: GenerationProfile = DEFAULT_PROFILE) -> str:
+    """
+    Answer a question in the context of earlier session turns. Follow-ups that can resume the
+    session's cached state go through InferenceBackend.generate_turn; everything else (first
+    turns, image turns, sessions with nothing cached) shares a batch with concurrent requests.
+    """
+    key = cache_key(image, query, history, profile)
+    answer = answer_cache.get(key)
+    if answer is None:
+        if backend.reuses_session(image, history, session_key):
+            with timed("generate_turn"):
+                answer, complete = backend.generate_turn(image, query, history, session_key, profile)
+        else:
+            answer, complete = batcher.run(((image, query, tuple(history), session_key), profile))
+        if complete:
+            answer_cache.put(key, answer)
+    return answer
+
+_END = object()
+
+async def _iter_stream(chunks: asyncio.Queue, cancelled: threading.Event) -> AsyncIterator[str]:
+    try:
+        while True:
+            item = await chunks.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if item:
+                yield item
+    finally:
+        # Stop generating if the client went away before the end of the answer
+        cancelled.set()
+
+def stream_vlm(image: Image.Image = None, query: str = "", history: Sequence[Dict[str, str]] = (),
+               session_key: Optional[Tuple[str, str]] = None, profile: GenerationProfile = DEFAULT_PROFILE) -> AsyncIterator[str]:
+    """
+    Start generation on the inference executor and return an async iterator of decoded text chunks.
+    Must be called from the event loop. Raises InferenceQueueFull straight away when the
+    executor cannot admit the job. The other arguments are as for run_vlm_chat.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    cancelled = threading.Event()
+
+    def _emit(item):
+        loop.call_soon_threadsafe(chunks.put_nowait, item)
+
+    def _generate():
+        try:
+            # Cache lookup happens here rather than in the caller to keep image hashing off the event loop
+            key = cache_key(image, query, history, profile)
+            cached = answer_cache.get(key)
+            if cached is not None:
+                _emit(cached)
+            else:
+                with timed("generate_turn"):
+                    answer, complete = backend.generate_turn(
+                        image, query, history, session_key, profile, on_text=_emit, should_stop=cancelled.is_set
+                    )
+                # A cancelled or timed-out generation stopped early and is not the full answer
+                if complete:
+                    answer_cache.put(key, answer)
+            _emit(_END)
+        except Exception as exc:
+            _emit(exc)
+
+    inference_executor.submit(_generate)
+    return _iter_stream(chunks, cancelled)
+
+def queue_full_error() -> HTTPException:
+    return HTTPException(status_code=503, detail="Inference queue is full, please retry shortly.", headers={"Retry-After": "1"})
+
+def check_inference_capacity():
+    """Reject early, before any upload processing, when the model is not ready or the inference queue is saturated"""
+    ensure_model_ready()
+    if inference_executor.is_full():
+        raise queue_full_error()
+
+async def run_inference(fn: Callable, *args, **kwargs) -> Any:
+    """Run blocking model work on the dedicated inference executor"""
+    try:
+        return await inference_executor.run(fn, *args, **kwargs)
+    except InferenceQueueFull:
+        raise queue_full_error()
 
 @router.post("/vlm-query")
-def vlm_query(
+async def vlm_query(
     image_file: UploadFile = File(...),
-    query: str = Form(...)
+    query: str = Form(...),
+    profile: str = Form(DEFAULT_PROFILE.name, pattern=PROFILE_PATTERN)
 ):
-    image = Image.open(io.BytesIO(image_file.file.read()))
-    result = run_vlm(image, query)
+    check_inference_capacity()
+    image = Image.open(io.BytesIO(await image_file.read()))
+    result = await run_inference(run_vlm, image, query, PROFILES[profile])
     return {"result": result}
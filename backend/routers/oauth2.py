@@ -1,20 +1,16 @@
 import os
-from typing import Optional
-from datetime import datetime, timedelta
 
-from jose import jwt
 from authlib.integrations.starlette_client import OAuth
 from starlette.config import Config
 
 from fastapi import APIRouter, HTTPException, status, Request
 from fastapi.responses import RedirectResponse
 
+from utils.security import create_access_token
+
 router = APIRouter()
 
 config = Config('.env')
-SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
-ALGORITHM = os.getenv("ALGORITHM", "HS256")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 
@@ -42,13 +38,6 @@ oauth.register(
     userinfo_endpoint='https://graph.facebook.com/me?fields=id,name,email,picture'
 )
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
-
 @router.get("/login/google")
 async def login_via_google(request: Request):
     redirect_uri = f"{BACKEND_URL}/auth/oauth2/google/callback"
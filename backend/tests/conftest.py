@@ -0,0 +1,101 @@
+import os
+import re
+import sys
+
+import pytest
+
+# Tests import the backend modules the way main.py does, from backend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PAD, BOI, IMAGE, EOI = 0, 250, 251, 252
+SPECIAL_TOKENS = {"<boi>": BOI, "<img>": IMAGE, "<eoi>": EOI}
+IMAGE_TOKENS = 4
+
+
+class TinyTokenizer:
+    """One token per character, plus the Gemma 3 image markers; pads on the left"""
+    pad_token_id = PAD
+    eos_token_id = 1
+
+    def __call__(self, texts, return_tensors=None, padding=False, add_special_tokens=False):
+        import torch
+        from transformers import BatchEncoding
+
+        ids = [[SPECIAL_TOKENS.get(piece) or ord(piece) % 200 + 3 for piece in re.findall(r"<boi>|<img>|<eoi>|.", text, re.S)]
+               for text in texts]
+        if return_tensors is None:
+            return BatchEncoding({"input_ids": ids})
+        width = max(len(row) for row in ids)
+        mask = [[0] * (width - len(row)) + [1] * len(row) for row in ids]
+        ids = [[PAD] * (width - len(row)) + row for row in ids]
+        return BatchEncoding({"input_ids": torch.tensor(ids), "attention_mask": torch.tensor(mask)})
+
+    def decode(self, ids, skip_special_tokens=True, **kwargs):
+        ids = ids.tolist() if hasattr(ids, "tolist") else ids
+        return "".join(chr(i - 3) if 3 <= i < 203 else "" if skip_special_tokens else f"<{i}>" for i in ids)
+
+    def batch_decode(self, rows, skip_special_tokens=True, **kwargs):
+        return [self.decode(row, skip_special_tokens) for row in rows]
+
+
+class TinyProcessor:
+    """The parts of a Gemma 3 processor the transformers backend uses"""
+    boi_token = "<boi>"
+    full_image_sequence = "\n\n<boi>" + "<img>" * IMAGE_TOKENS + "<eoi>\n\n"
+    # As transformers 5 processors set it: the begin-of-image token, not the placeholder
+    image_token_id = BOI
+
+    def __init__(self):
+        from transformers import Gemma3ImageProcessor
+
+        self.tokenizer = TinyTokenizer()
+        self.image_processor = Gemma3ImageProcessor(size={"height": 28, "width": 28})
+
+    def apply_chat_template(self, conversations, add_generation_prompt, tokenize, return_dict=False,
+                            return_tensors=None, padding=False):
+        texts = [
+            "".join(f"{turn['role']}:" + "".join("<boi>" if part["type"] == "image" else part["text"] for part in turn["content"]) + "|"
+                    for turn in conversation) + ("model:" if add_generation_prompt else "")
+            for conversation in conversations
+        ]
+        if not tokenize:
+            return texts
+        from transformers import BatchFeature
+
+        return BatchFeature(dict(self.tokenizer(texts, return_tensors="pt", padding=padding)))
+
+    def decode(self, ids, skip_special_tokens=True):
+        return self.tokenizer.decode(ids, skip_special_tokens)
+
+    def batch_decode(self, rows, skip_special_tokens=True):
+        return self.tokenizer.batch_decode(rows, skip_special_tokens)
+
+
+@pytest.fixture
+def tiny_gemma_backend():
+    """TransformersBackend around a tiny random Gemma 3, on CPU in float32"""
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    from utils.kv_cache import session_kv_cache
+    from utils.transformers_backend import TransformersBackend
+
+    torch.manual_seed(0)
+    config = transformers.Gemma3Config(
+        text_config=dict(vocab_size=256, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=2, num_key_value_heads=1, head_dim=16, initializer_range=0.2),
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2,
+                           image_size=28, patch_size=7),
+        mm_tokens_per_image=IMAGE_TOKENS, image_token_id=IMAGE, boi_token_id=BOI, eoi_token_id=EOI, initializer_range=0.2,
+    )
+    model = transformers.Gemma3ForConditionalGeneration(config).eval()
+    # An untied random head, so greedy decoding wanders instead of repeating one token
+    model.lm_head.weight = torch.nn.Parameter(torch.randn_like(model.lm_head.weight))
+    model.generation_config.pad_token_id = PAD
+    backend = TransformersBackend()
+    backend.processor, backend.model, backend.dtype = TinyProcessor(), model, torch.float32
+    # Session caches are process-wide; start every test without any
+    session_kv_cache._sessions.clear()
+    session_kv_cache._prefixes.clear()
+    yield backend
+    session_kv_cache._sessions.clear()
+    session_kv_cache._prefixes.clear()
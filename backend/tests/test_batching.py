@@ -0,0 +1,73 @@
+"""BatchScheduler driven by a stand-in batch function, no model needed"""
+import time
+import threading
+
+import pytest
+
+from utils.batching import BatchScheduler
+
+
+class _RecordingBatch:
+    def __init__(self, fail: bool = False):
+        self.batches = []
+        self.fail = fail
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        if self.fail:
+            raise ValueError("model error")
+        return [item * 10 for item in items]
+
+def test_concurrent_submits_coalesce_into_one_batch():
+    batch_fn = _RecordingBatch()
+    scheduler = BatchScheduler(batch_fn, max_batch_size=4, max_wait_ms=5000)
+    results = {}
+    start = threading.Barrier(4)
+
+    def submit(item):
+        start.wait()
+        results[item] = scheduler.run(item)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {0: 0, 1: 10, 2: 20, 3: 30}
+    assert len(batch_fn.batches) == 1 and sorted(batch_fn.batches[0]) == [0, 1, 2, 3]
+    # A full batch runs at once instead of waiting out the window
+    assert time.monotonic() - started < 2
+
+def test_partial_batch_flushes_after_max_wait():
+    batch_fn = _RecordingBatch()
+    scheduler = BatchScheduler(batch_fn, max_batch_size=8, max_wait_ms=50)
+
+    started = time.monotonic()
+    futures = [scheduler.submit(i) for i in range(3)]
+    assert [future.result(timeout=5) for future in futures] == [0, 10, 20]
+    elapsed = time.monotonic() - started
+
+    assert batch_fn.batches == [[0, 1, 2]]
+    assert 0.04 <= elapsed < 1
+
+def test_batch_error_reaches_every_waiter():
+    scheduler = BatchScheduler(_RecordingBatch(fail=True), max_batch_size=3, max_wait_ms=1000)
+
+    futures = [scheduler.submit(i) for i in range(3)]
+    for future in futures:
+        with pytest.raises(ValueError, match="model error"):
+            future.result(timeout=5)
+
+    # The worker survives a failed batch
+    scheduler.batch_fn = _RecordingBatch()
+    assert scheduler.run(7) == 70
+
+def test_wrong_number_of_results_fails_the_batch():
+    scheduler = BatchScheduler(lambda items: items[:-1], max_batch_size=2, max_wait_ms=1000)
+
+    futures = [scheduler.submit(i) for i in range(2)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="2 items"):
+            future.result(timeout=5)
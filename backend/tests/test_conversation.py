@@ -0,0 +1,38 @@
+"""Context window over session history"""
+from utils.conversation import context_window, history_turns
+
+
+def _messages(count):
+    return [{"sender": "user" if i % 2 == 0 else "ai", "text": f"message {i}"} for i in range(count)]
+
+def test_window_moves_in_blocks():
+    assert [context_window(n, max_messages=20, drop_messages=10) for n in (0, 5, 20, 21, 29, 30, 31)] == [0, 5, 20, 11, 19, 20, 11]
+
+def test_history_prefix_is_stable_between_drops():
+    turns = [history_turns(_messages(n), max_messages=20, max_chars=10000, drop_messages=10) for n in range(22, 34, 2)]
+    # Sessions of 22..30 messages all start the context at message 10; past 30 it moves on to message 20
+    for shorter, longer in zip(turns[:4], turns[1:5]):
+        assert longer[:len(shorter)] == shorter
+    assert turns[0][0]["text"] == "message 10"
+    assert turns[5][0]["text"] == "message 20"
+
+def test_char_budget_drops_whole_blocks():
+    messages = [{"sender": "user" if i % 2 == 0 else "ai", "text": "x" * 100} for i in range(20)]
+    turns = history_turns(messages, max_messages=20, max_chars=1500, drop_messages=10)
+    assert len(turns) == 10
+
+def test_failed_turns_are_not_replayed():
+    messages = [
+        {"sender": "user", "text": "first"},
+        {"sender": "ai", "text": "answer"},
+        {"sender": "user", "text": "lost"},
+        {"sender": "ai", "text": "Error: Unable to get response from AI. Status: 503", "error": True},
+        {"sender": "user", "text": "second"},
+        {"sender": "ai", "text": "another answer"},
+    ]
+    assert history_turns(messages) == [
+        {"role": "user", "text": "first"},
+        {"role": "assistant", "text": "answer"},
+        {"role": "user", "text": "second"},
+        {"role": "assistant", "text": "another answer"},
+    ]
@@ -0,0 +1,30 @@
+"""Source type detection of render_to_file"""
+from PIL import Image
+
+from utils import pdf_render
+
+
+def test_extensionless_pdf_is_rendered_as_a_pdf(tmp_path, monkeypatch):
+    rendered = []
+
+    def render_pdf_page(pdf_path, page, dpi=pdf_render.PDF_RENDER_DPI, max_side=None):
+        rendered.append((pdf_path, page))
+        return Image.new("RGB", (20, 10), "white")
+
+    monkeypatch.setattr(pdf_render, "render_pdf_page", render_pdf_page)
+    for name in ("upload.file", "scan.PDF.bin"):
+        source = tmp_path / name
+        source.write_bytes(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        target = tmp_path / f"{name}.png"
+        assert pdf_render.render_to_file(str(source), str(target)) == target.stat().st_size
+        assert rendered[-1] == (str(source), 1)
+        with Image.open(target) as img:
+            assert img.size == (20, 10)
+
+def test_image_named_like_a_pdf_is_opened_as_an_image(tmp_path):
+    source = tmp_path / "photo.pdf"
+    Image.new("RGB", (40, 30), "red").save(source, format="PNG")
+    target = tmp_path / "out.png"
+    pdf_render.render_to_file(str(source), str(target), max_side=20)
+    with Image.open(target) as img:
+        assert img.size == (20, 15)
@@ -0,0 +1,191 @@
+"""TransformersBackend generation, batching and caches on a tiny random Gemma 3, CPU only"""
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from PIL import Image
+
+from conftest import IMAGE_TOKENS
+from utils.inference_backends import build_messages
+
+
+def test_cached_image_embeddings_match_pixel_values(tiny_gemma_backend):
+    backend = tiny_gemma_backend
+    image = Image.new("RGB", (40, 30), (200, 10, 10))
+    conversation = [[{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": "what is this?"}]}]]
+
+    assert backend._supports_vision_cache()
+    inputs = backend.prepare_inputs(conversation, [image])
+    assert int(inputs["token_type_ids"].sum()) == IMAGE_TOKENS
+
+    pixel_values = backend.processor.image_processor(images=[image], return_tensors="pt")["pixel_values"]
+    with torch.no_grad():
+        expected = backend.model(input_ids=inputs["input_ids"], pixel_values=pixel_values,
+                                 attention_mask=inputs["attention_mask"], token_type_ids=inputs["token_type_ids"]).logits
+        actual = backend.model(inputs_embeds=inputs["inputs_embeds"], attention_mask=inputs["attention_mask"],
+                               token_type_ids=inputs["token_type_ids"]).logits
+    assert torch.allclose(expected, actual, atol=1e-5)
+
+    # A second question about the same image is served from the vision cache
+    again = backend.prepare_inputs(conversation, [image])
+    assert backend.vision_cache.stats()["hits"] == 1
+    assert torch.equal(again["inputs_embeds"], inputs["inputs_embeds"])
+
+def test_image_turn_matches_generate_with_pixel_values(tiny_gemma_backend):
+    from utils.generation_profiles import GenerationProfile
+
+    backend = tiny_gemma_backend
+    profile = GenerationProfile("test", max_new_tokens=6)
+    image = Image.new("RGB", (40, 30), (200, 10, 10))
+    answer, complete = backend.generate_turn(image, "what is this?", (), None, profile)
+
+    inputs = backend.prepare_inputs([build_messages(image, "what is this?", (), profile.system_prompt)], [image])
+    pixel_values = backend.processor.image_processor(images=[image], return_tensors="pt")["pixel_values"]
+    with torch.no_grad():
+        output = backend.model.generate(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"],
+                                        token_type_ids=inputs["token_type_ids"], pixel_values=pixel_values,
+                                        max_new_tokens=6, do_sample=False)
+    expected = backend.processor.decode(output[0, inputs["input_ids"].shape[-1]:], skip_special_tokens=True)
+    assert complete and answer and answer == expected
+
+def test_batched_session_turn_leaves_a_cache_the_follow_up_resumes(tiny_gemma_backend):
+    from utils.generation_profiles import GenerationProfile
+    from utils.kv_cache import session_kv_cache
+
+    backend = tiny_gemma_backend
+    profile = GenerationProfile("test", max_new_tokens=6)
+    # First turns of two sessions, padded to different lengths in one batch
+    requests = [(None, "hi", (), ("user", "a")), (None, "a much longer first question", (), ("user", "b"))]
+    answers = backend.generate_batch(requests, profile)
+
+    history = [{"role": "user", "text": "a much longer first question"}, {"role": "assistant", "text": answers[1][0]}]
+    assert backend.reuses_session(None, history, ("user", "b"))
+    assert not backend.reuses_session(None, history, ("user", "unknown"))
+    assert not backend.reuses_session(None, (), ("user", "b"))
+
+    reused = session_kv_cache.reused_tokens
+    follow_up = backend.generate_turn(None, "and then?", history, ("user", "b"), profile)
+    assert session_kv_cache.session_hits == 1
+    assert session_kv_cache.reused_tokens - reused > len("a much longer first question")
+
+    # Same answer as prefilling the whole conversation from scratch
+    session_kv_cache._sessions.clear()
+    session_kv_cache._prefixes.clear()
+    session_kv_cache.enabled = False
+    try:
+        assert backend.generate_turn(None, "and then?", history, None, profile) == follow_up
+    finally:
+        session_kv_cache.enabled = True
+
+def test_long_session_keeps_reusing_its_kv_cache(tiny_gemma_backend):
+    """Past the context window, old turns leave in blocks and most turns still resume the session cache"""
+    from utils.conversation import history_turns
+    from utils.generation_profiles import GenerationProfile
+    from utils.kv_cache import session_kv_cache
+
+    backend = tiny_gemma_backend
+    profile = GenerationProfile("test", max_new_tokens=4)
+    session_key = ("user", "long")
+    messages = []
+    reusing_turns = 0
+    for turn in range(30):
+        history = history_turns(messages, max_messages=20, max_chars=8000, drop_messages=10)
+        prompt_tokens = backend.prepare_inputs(
+            [build_messages(None, f"question {turn}", history, profile.system_prompt)], [None])["input_ids"].shape[-1]
+        reused = session_kv_cache.reused_tokens
+        answer, _ = backend.generate_turn(None, f"question {turn}", history, session_key, profile)
+        if turn >= 10 and session_kv_cache.reused_tokens - reused > prompt_tokens // 2:
+            reusing_turns += 1
+        messages += [{"sender": "user", "text": f"question {turn}"}, {"sender": "ai", "text": answer or "-"}]
+
+    # Turns 10..29 run past the 20-message window; only the turns where a block drops off re-prefill
+    assert reusing_turns >= 15
+
+def test_system_prefix_prefill_waits_for_a_generate_slot(tiny_gemma_backend):
+    import threading
+    from utils.kv_cache import session_kv_cache
+
+    backend = tiny_gemma_backend
+    backend._generate_slots = threading.BoundedSemaphore(1)
+    backend._generate_slots.acquire()
+    worker = threading.Thread(target=backend._ensure_system_prefix, args=("You are a test.",))
+    worker.start()
+    worker.join(0.3)
+    assert worker.is_alive() and not session_kv_cache.has_prefix("You are a test.")
+
+    backend._generate_slots.release()
+    worker.join(10)
+    assert session_kv_cache.has_prefix("You are a test.")
+
+def _single_turn_answers(backend, requests, profile):
+    """generate_turn for each request on its own, prefilled from scratch"""
+    from utils.kv_cache import session_kv_cache
+
+    session_kv_cache.enabled = False
+    try:
+        return [backend.generate_turn(image, query, history, None, profile) for image, query, history, _ in requests]
+    finally:
+        session_kv_cache.enabled = True
+
+def _record_generate_calls(backend, monkeypatch):
+    calls = []
+    generate = backend._generate
+
+    def recording_generate(inputs, profile, **generate_kwargs):
+        calls.append((inputs, profile))
+        return generate(inputs, profile, **generate_kwargs)
+
+    monkeypatch.setattr(backend, "_generate", recording_generate)
+    return calls
+
+def test_mixed_batch_matches_single_turns(tiny_gemma_backend, monkeypatch):
+    from utils.generation_profiles import GenerationProfile
+
+    backend = tiny_gemma_backend
+    profile = GenerationProfile("test", max_new_tokens=6)
+    red, blue = Image.new("RGB", (40, 30), (200, 10, 10)), Image.new("RGB", (24, 36), (10, 10, 200))
+    requests = [
+        (None, "hi", (), None),
+        (red, "what is shown in this picture?", (), None),
+        (None, "a much longer text question than the first", (), None),
+        (blue, "and here?", (), None),
+        (None, "and then?", ({"role": "user", "text": "earlier"}, {"role": "assistant", "text": "reply"}), None),
+    ]
+    calls = _record_generate_calls(backend, monkeypatch)
+    batched = backend.generate_batch(requests, profile)
+
+    # One generate for the text prompts and one for the image prompts, each left-padded
+    assert len(calls) == 2
+    image_counts = sorted(int(inputs["token_type_ids"].sum()) if "token_type_ids" in inputs else 0 for inputs, _ in calls)
+    assert image_counts == [0, 2 * IMAGE_TOKENS]
+    for inputs, _ in calls:
+        mask = inputs["attention_mask"]
+        assert mask[:, -1].all() and not mask[:, 0].all()
+
+    assert batched == _single_turn_answers(backend, requests, profile)
+    assert len(set(answer for answer, _ in batched)) > 1
+
+def test_run_vlm_batch_groups_by_profile(tiny_gemma_backend, monkeypatch):
+    from routers import model_api
+    from utils.generation_profiles import GenerationProfile
+
+    backend = tiny_gemma_backend
+    monkeypatch.setattr(model_api, "backend", backend)
+    brief, longer = GenerationProfile("brief", max_new_tokens=3), GenerationProfile("longer", max_new_tokens=7)
+    image = Image.new("RGB", (40, 30), (200, 10, 10))
+    items = [
+        ((None, "first question", (), None), brief),
+        ((image, "what is this?", (), None), longer),
+        ((None, "second, longer question", (), None), longer),
+        ((image, "describe it", (), None), brief),
+        ((None, "q", (), None), brief),
+    ]
+    calls = _record_generate_calls(backend, monkeypatch)
+    results = model_api._run_vlm_batch(items)
+
+    # Per profile, one generate for its text requests and one for its image requests
+    assert sorted((profile.name, inputs["input_ids"].shape[0]) for inputs, profile in calls) == [
+        ("brief", 1), ("brief", 2), ("longer", 1), ("longer", 1)]
+    # Every caller gets the answer to its own request
+    for (request, profile), result in zip(items, results):
+        assert result == _single_turn_answers(backend, [request], profile)[0]
@@ -0,0 +1,141 @@
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Dict, Optional, Sequence
+
+from PIL import Image
+
+from utils.lru_cache import LRUCache
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000"))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+ANSWER_CACHE_MAX_ENTRY_BYTES = int(os.getenv("ANSWER_CACHE_MAX_ENTRY_BYTES", str(16 * 1024)))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+# SQLite file that keeps answers across restarts; empty keeps the cache in memory only
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "")
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(text: str) -> str:
+    """Collapse whitespace and case so trivially different phrasings share an entry"""
+    return _WHITESPACE.sub(" ", text or "").strip().casefold()
+
+def image_hash(image: Optional[Image.Image]) -> Optional[str]:
+    """
+    SHA-256 of the decoded pixels, so the same picture matches whatever file it came from.
+    Memoized on the image object, which several caches key on during one request.
+    """
+    if image is None:
+        return None
+    cached = getattr(image, "_content_sha256", None)
+    if cached is None:
+        digest = hashlib.sha256(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode("utf-8"))
+        digest.update(image.tobytes())
+        cached = image._content_sha256 = digest.hexdigest()
+    return cached
+
+def answer_key(system_prompt: str, query: str, image_digest: Optional[str], settings: Dict[str, Any],
+               history: Sequence[Dict[str, str]] = ()) -> str:
+    """``history`` is the conversation before ``query`` as {"role", "text"} turns"""
+    turns = [[turn["role"], normalize_prompt(turn["text"])] for turn in history]
+    payload = [normalize_prompt(system_prompt), turns, normalize_prompt(query), image_digest, settings]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    Cache of answers from deterministic (greedy) generation, keyed by answer_key.
+
+    Entries live in an in-memory LRU with a TTL. With ``path`` they are also written
+    to SQLite, so a restart or another worker process finds them on a memory miss.
+    Answers longer than ``max_entry_bytes`` are not cached.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        max_bytes: int = ANSWER_CACHE_MAX_BYTES,
+        max_entry_bytes: int = ANSWER_CACHE_MAX_ENTRY_BYTES,
+        ttl: float = ANSWER_CACHE_TTL_SECONDS,
+        path: str = ANSWER_CACHE_PATH,
+    ):
+        self.max_entries = max_entries
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self._memory = LRUCache(max_entries=max_entries, max_bytes=max_bytes, sizeof=lambda answer: len(answer.encode("utf-8")), ttl=ttl)
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._writes = 0
+        self.disk_hits = 0
+        self.too_large = 0
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, answer TEXT NOT NULL, created_at REAL NOT NULL)")
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        answer = self._memory.get(key)
+        if answer is not None or self._db is None:
+            return answer
+        with self._db_lock:
+            row = self._db.execute("SELECT answer, created_at FROM answers WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        remaining = row[1] + self.ttl - time.time()
+        if remaining <= 0:
+            return None
+        self.disk_hits += 1
+        self._memory.put(key, row[0], ttl=remaining)
+        return row[0]
+
+    def put(self, key: str, answer: str) -> bool:
+        if not answer:
+            return False
+        if len(answer.encode("utf-8")) > self.max_entry_bytes:
+            self.too_large += 1
+            return False
+        self._memory.put(key, answer)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("INSERT OR REPLACE INTO answers (key, answer, created_at) VALUES (?, ?, ?)", (key, answer, time.time()))
+                self._writes += 1
+                if self._writes % 1000 == 0:
+                    self._prune()
+                self._db.commit()
+        return True
+
+    def _prune(self):
+        """Drop expired rows and keep at most max_entries of the newest"""
+        self._db.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - self.ttl,))
+        self._db.execute(
+            "DELETE FROM answers WHERE key NOT IN (SELECT key FROM answers ORDER BY created_at DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+
+    def clear(self):
+        self._memory.clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM answers")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self._memory.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hits = stats["hits"] + self.disk_hits
+        stats.update(
+            disk_hits=self.disk_hits,
+            too_large=self.too_large,
+            hit_rate=hits / lookups if lookups else 0.0,
+        )
+        return stats
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,73 @@
+import os
+from typing import Any, Dict, List, Sequence
+
+# How much of a session's stored history is fed back to the model as context
+CHAT_CONTEXT_MAX_MESSAGES = int(os.getenv("CHAT_CONTEXT_MAX_MESSAGES", "20"))
+CHAT_CONTEXT_MAX_CHARS = int(os.getenv("CHAT_CONTEXT_MAX_CHARS", "8000"))
+# Old messages leave the context this many at a time, so the prompt prefix (and the
+# session's KV cache) stays the same between turns instead of shifting on every one
+CHAT_CONTEXT_DROP_MESSAGES = int(os.getenv("CHAT_CONTEXT_DROP_MESSAGES", "10"))
+
+
+def _drop_block(max_messages: int, drop_messages: int) -> int:
+    return max(1, min(drop_messages, max_messages))
+
+def context_window(
+    message_count: int,
+    max_messages: int = CHAT_CONTEXT_MAX_MESSAGES,
+    drop_messages: int = CHAT_CONTEXT_DROP_MESSAGES,
+) -> int:
+    """
+    How many of a session's latest messages are context for its next question: at most
+    ``max_messages``, starting at a multiple of ``drop_messages`` so the window only moves
+    when a whole block of old messages falls out of it.
+    """
+    if max_messages <= 0:
+        return 0
+    block = _drop_block(max_messages, drop_messages)
+    start = max(0, message_count - max_messages)
+    start = -(-start // block) * block
+    return message_count - start
+
+def history_turns(
+    messages: Sequence[Dict[str, Any]],
+    max_messages: int = CHAT_CONTEXT_MAX_MESSAGES,
+    max_chars: int = CHAT_CONTEXT_MAX_CHARS,
+    drop_messages: int = CHAT_CONTEXT_DROP_MESSAGES,
+) -> List[Dict[str, str]]:
+    """
+    Turn stored session messages (oldest first, starting at the first message of the session
+    or of a context_window) into alternating {"role", "text"} turns that start with the user
+    and end with the assistant, ready for the next question. Only the most recent messages
+    within ``max_messages`` and ``max_chars`` are kept, dropped from the front in blocks of
+    ``drop_messages``. Attachments are not replayed: earlier turns are context as text only.
+    """
+    messages = list(messages)
+    block = _drop_block(max_messages, drop_messages)
+    start = len(messages) - context_window(len(messages), max_messages, drop_messages)
+    while start < len(messages) and sum(len((m.get("text") or "").strip()) for m in messages[start:]) > max_chars:
+        start += block
+
+    turns = []
+    for message in messages[start:]:
+        # A failure notice is no answer: leave it and the question it failed out of the context
+        if message.get("error"):
+            if turns and turns[-1]["role"] == "user":
+                turns.pop()
+            continue
+        text = (message.get("text") or "").strip()
+        if not text:
+            continue
+        role = "assistant" if message.get("sender") == "ai" else "user"
+        # Chat templates require roles to alternate, so merge consecutive messages from one side
+        if turns and turns[-1]["role"] == role:
+            turns[-1]["text"] += "\n\n" + text
+        else:
+            turns.append({"role": role, "text": text})
+
+    # The new question follows, so an unanswered trailing question is dropped
+    while turns and turns[-1]["role"] == "user":
+        turns.pop()
+    while turns and turns[0]["role"] != "user":
+        turns.pop(0)
+    return turns
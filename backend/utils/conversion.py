@@ -0,0 +1,143 @@
+import os
+import time
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+from PIL import Image
+
+from utils.metrics import observe_stage
+from utils.pdf_render import (
+    IMAGE_QUALITY, PDF_RENDER_DPI, image_file_base64, image_file_bytes, pdf_page_count,
+    render_pdf_page, render_pdf_page_base64, render_pdf_page_bytes,
+)
+
+CONVERSION_WORKERS = int(os.getenv("CONVERSION_WORKERS", str(os.cpu_count() or 2)))
+CONVERSION_QUEUE_SIZE = int(os.getenv("CONVERSION_QUEUE_SIZE", "64"))
+
+
+class ConversionQueueFull(Exception):
+    """Raised when new conversion work arrives while the queue is already full"""
+
+
+class ConversionService:
+    """
+    Shared process pool for CPU-bound upload conversion: poppler rasterization,
+    PIL re-encoding and base64 encoding run outside the web worker's GIL.
+
+    At most ``max_pending`` jobs are queued or running across all requests. A new
+    request is rejected straight away when the queue is full; once admitted, its
+    remaining pages wait for free slots instead of failing halfway through.
+    """
+
+    def __init__(self, workers: int = CONVERSION_WORKERS, max_pending: int = CONVERSION_QUEUE_SIZE):
+        self.workers = max(1, workers)
+        self.max_pending = max(self.workers, max_pending)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._pool = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # spawn rather than fork: the parent runs model and scheduler threads
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def pending(self) -> int:
+        return self._pending
+
+    def is_full(self) -> bool:
+        return self._pending >= self.max_pending
+
+    def submit(self, fn: Callable, *args, block: bool = False, **kwargs) -> Future:
+        if not self._slots.acquire(blocking=block):
+            raise ConversionQueueFull("Conversion queue is full")
+        with self._lock:
+            self._pending += 1
+        started = time.perf_counter()
+        try:
+            future = self._get_pool().submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        # Timed from admission, so the stage includes waiting for a free worker
+        stage = "conversion." + getattr(fn, "__name__", "job").lstrip("_")
+        future.add_done_callback(lambda _: self._release(stage, started))
+        return future
+
+    def _release(self, stage: Optional[str] = None, started: float = 0.0):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+        if stage is not None:
+            observe_stage(stage, time.perf_counter() - started)
+
+    def run(self, fn: Callable, *args, **kwargs) -> Any:
+        return self.submit(fn, *args, **kwargs).result()
+
+    def map_ordered(self, fn: Callable, items: Iterable, *args, window: Optional[int] = None) -> Iterator[Any]:
+        """
+        Yield ``fn(item, *args)`` for each item, in order, as soon as each result is ready.
+        Keeps ``window`` jobs in flight so results stream out while later items convert,
+        without materializing every result at once.
+        """
+        window = window or self.workers
+        in_flight = deque()
+        try:
+            for index, item in enumerate(items):
+                in_flight.append(self.submit(fn, item, *args, block=index > 0))
+                if len(in_flight) >= window:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            # Consumer stopped early (error or client disconnect): drop queued work
+            for future in in_flight:
+                future.cancel()
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Pool entry points take the page first to suit map_ordered
+
+def _render_page(page: int, pdf_path: str, dpi: int, max_side: Optional[int]) -> Image.Image:
+    return render_pdf_page(pdf_path, page, dpi, max_side)
+
+def _render_page_base64(page: int, pdf_path: str, dpi: int, image_format: str, quality: int) -> str:
+    return render_pdf_page_base64(pdf_path, page, dpi, image_format, quality)
+
+def _render_page_bytes(page: int, pdf_path: str, dpi: int, image_format: str, quality: int) -> bytes:
+    return render_pdf_page_bytes(pdf_path, page, dpi, image_format, quality)
+
+def render_pdf_pages(pdf_path: str, pages: List[int], dpi: int = PDF_RENDER_DPI, max_side: Optional[int] = None) -> List[Image.Image]:
+    """Rasterize only the requested 1-based pages, in order, in parallel on the conversion pool"""
+    return list(conversion_service.map_ordered(_render_page, pages, pdf_path, dpi, max_side))
+
+def iter_pdf_pages_base64(pdf_path: str, dpi: int = 200, image_format: str = "png", quality: int = IMAGE_QUALITY) -> Iterator[str]:
+    """Yield every page of a PDF base64-encoded, in order, as soon as each one is converted"""
+    pages = range(1, pdf_page_count(pdf_path) + 1)
+    yield from conversion_service.map_ordered(_render_page_base64, pages, pdf_path, dpi, image_format, quality)
+
+def iter_pdf_pages_bytes(pdf_path: str, dpi: int = 200, image_format: str = "png", quality: int = IMAGE_QUALITY) -> Iterator[bytes]:
+    """Yield every page of a PDF as encoded image bytes, in order, as soon as each one is converted"""
+    pages = range(1, pdf_page_count(pdf_path) + 1)
+    yield from conversion_service.map_ordered(_render_page_bytes, pages, pdf_path, dpi, image_format, quality)
+
+def image_to_bytes(image_path: str, image_format: str = "png", quality: int = IMAGE_QUALITY) -> bytes:
+    """Re-encode an image file in ``image_format`` on the conversion pool"""
+    return conversion_service.run(image_file_bytes, image_path, image_format, quality)
+
+def image_to_base64(image_path: str, image_format: str = "png", quality: int = IMAGE_QUALITY) -> str:
+    """Re-encode an image file base64-encoded on the conversion pool"""
+    return conversion_service.run(image_file_base64, image_path, image_format, quality)
+
+
+conversion_service = ConversionService()
@@ -0,0 +1,95 @@
+import os
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from utils.conversion import render_pdf_pages
+from utils.pdf_render import PDF_RENDER_DPI, pdf_page_count
+
+DOC_QA_MAX_PAGES = int(os.getenv("DOC_QA_MAX_PAGES", "30"))
+DOC_QA_BATCH_PAGES = int(os.getenv("DOC_QA_BATCH_PAGES", "4"))
+# Budget for the page notes passed to the final answer, in tokens (approximated as 4 characters each)
+DOC_QA_MAX_CONTEXT_TOKENS = int(os.getenv("DOC_QA_MAX_CONTEXT_TOKENS", "2000"))
+
+NOT_RELEVANT = "NOT RELEVANT"
+
+# Runs several (image, prompt) requests together and returns one answer per request
+AskMany = Callable[[Sequence[Tuple[Optional[Image.Image], str]]], List[str]]
+# Called as progress(stage, done, total)
+Progress = Callable[[str, int, int], None]
+
+
+def page_prompt(question: str, page: int, total: int) -> str:
+    return (
+        f"This is page {page} of {total} of a medical document. "
+        f"Using only this page, answer the question: {question}\n"
+        f"If the page contains nothing relevant to the question, reply exactly: {NOT_RELEVANT}"
+    )
+
+def reduce_prompt(question: str, notes: Dict[int, str]) -> str:
+    findings = "\n\n".join(f"[Page {page}]\n{note}" for page, note in notes.items())
+    return (
+        "The following notes were extracted from individual pages of a medical document.\n\n"
+        f"{findings}\n\n"
+        f"Using these notes, answer the question and cite the pages you relied on: {question}"
+    )
+
+def _is_relevant(answer: str) -> bool:
+    return bool(answer.strip()) and NOT_RELEVANT not in answer.upper()
+
+def _fit_notes(notes: Dict[int, str], max_tokens: int) -> Dict[int, str]:
+    """Share the context budget evenly between pages, truncating the longer notes"""
+    if not notes:
+        return notes
+    per_page = max(1, max_tokens * 4 // len(notes))
+    return {page: note.strip()[:per_page] for page, note in notes.items()}
+
+def answer_document(
+    pdf_path: str,
+    question: str,
+    ask_many: AskMany,
+    max_pages: int = DOC_QA_MAX_PAGES,
+    batch_pages: int = DOC_QA_BATCH_PAGES,
+    max_context_tokens: int = DOC_QA_MAX_CONTEXT_TOKENS,
+    dpi: int = PDF_RENDER_DPI,
+    max_side: Optional[int] = None,
+    progress: Optional[Progress] = None,
+) -> Dict[str, object]:
+    """
+    Map-reduce question answering over a PDF.
+
+    Pages are rendered ``batch_pages`` at a time and each batch is asked the question
+    in one ``ask_many`` call, so only one batch of page images is in memory at once.
+    Relevant per-page answers are then combined into a final text-only answer.
+    At most ``max_pages`` pages are read.
+    """
+    total_pages = pdf_page_count(pdf_path)
+    pages = list(range(1, min(total_pages, max_pages) + 1))
+    notes = {}
+
+    for start in range(0, len(pages), max(1, batch_pages)):
+        batch = pages[start:start + batch_pages]
+        images = render_pdf_pages(pdf_path, batch, dpi=dpi, max_side=max_side)
+        answers = ask_many([(image, page_prompt(question, page, total_pages)) for page, image in zip(batch, images)])
+        del images
+        for page, answer in zip(batch, answers):
+            if _is_relevant(answer):
+                notes[page] = answer
+        if progress:
+            progress("pages", start + len(batch), len(pages))
+
+    if not notes:
+        answer = "The document does not appear to contain information relevant to this question."
+    elif len(notes) == 1:
+        answer = next(iter(notes.values()))
+    else:
+        if progress:
+            progress("combining", 0, 1)
+        answer = ask_many([(None, reduce_prompt(question, _fit_notes(notes, max_context_tokens)))])[0]
+
+    return {
+        "result": answer,
+        "pages_read": len(pages),
+        "total_pages": total_pages,
+        "relevant_pages": sorted(notes),
+    }
@@ -1,10 +1,43 @@
+import io
 import os
-import uuid
-from datetime import datetime
-from typing import Optional
+import re
+import json
+import time
+import hashlib
+import tempfile
+from collections import Counter
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from utils.locks import StripedLock
+from utils.metrics import timed
 
 UPLOADS_DIR = "uploads"
 USERS_DIR = os.path.join(UPLOADS_DIR, "users")
+# Per-user index of stored files: how many chat messages reference each filename
+REFS_FILENAME = ".refs.json"
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+CHUNK_SIZE = 1024 * 1024
+
+_SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+_user_locks = StripedLock()
+# Uploads stored by this process and not yet referenced by a message:
+# (user_id, filename) -> [requests holding the upload, time of the latest one]
+_pending_uploads: Dict[Tuple[str, str], List] = {}
+
+class UploadTooLarge(Exception):
+    """Raised when an upload exceeds MAX_UPLOAD_BYTES"""
+
+def copy_stream(source: BinaryIO, target: BinaryIO, max_bytes: Optional[int] = MAX_UPLOAD_BYTES, digest=None) -> int:
+    """Copy ``source`` to ``target`` in chunks, updating ``digest`` as it goes; return bytes copied"""
+    total = 0
+    for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+        total += len(chunk)
+        if max_bytes is not None and total > max_bytes:
+            raise UploadTooLarge(f"Upload exceeds the {max_bytes} byte limit")
+        if digest is not None:
+            digest.update(chunk)
+        target.write(chunk)
+    return total
 
 def ensure_user_upload_dir(user_id: str) -> str:
     """Create and return user-specific upload directory"""
@@ -12,30 +45,87 @@ def ensure_user_upload_dir(user_id: str) -> str:
     os.makedirs(user_dir, exist_ok=True)
     return user_dir
 
-def generate_unique_filename(original_filename: str) -> str:
-    """Generate unique filename preserving extension"""
-    if not original_filename:
-        return f"{uuid.uuid4()}.file"
+def content_filename(digest: str, original_filename: str) -> str:
+    """Content-addressed filename: the SHA-256 of the bytes plus the original extension"""
+    ext = os.path.splitext(original_filename or "")[1].lower()
+    return f"{digest}{ext or '.file'}"
 
-    name, ext = os.path.splitext(original_filename)
-    if not ext:
-        ext = ".file"
+def _relative_path(user_id: str, filename: str) -> str:
+    # Relative path from backend root, as stored in chat messages
+    return os.path.join(USERS_DIR, user_id, filename).replace("\\", "/")
+
+def _load_refs(user_dir: str) -> Dict[str, int]:
+    path = os.path.join(user_dir, REFS_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
-    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    unique_id = str(uuid.uuid4())[:8]
-    return f"{timestamp}_{unique_id}{ext}"
+def _save_refs(user_dir: str, refs: Dict[str, int]):
+    _atomic_write(os.path.join(user_dir, REFS_FILENAME), json.dumps(refs).encode("utf-8"))
+
+def _atomic_write(path: str, data: bytes):
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 def save_uploaded_file(file_content: bytes, user_id: str, original_filename: str) -> str:
-    """Save uploaded file and return relative file path"""
+    """Save in-memory file content; see save_upload_stream"""
+    return save_upload_stream(io.BytesIO(file_content), user_id, original_filename, max_bytes=None)
+
+@timed("upload_write")
+def save_upload_stream(stream: BinaryIO, user_id: str, original_filename: str, max_bytes: Optional[int] = MAX_UPLOAD_BYTES) -> str:
+    """
+    Stream an upload to disk in chunks under its content hash and return the relative file path.
+    Re-uploading identical bytes returns the existing path instead of a copy.
+    Raises UploadTooLarge as soon as more than ``max_bytes`` have been read.
+
+    The upload is pending until a message referencing it is appended (add_file_refs);
+    a failed request gives it back with discard_upload, and uploads no message ever
+    claims are removed by the orphan sweep (utils.upload_gc).
+    """
     user_dir = ensure_user_upload_dir(user_id)
-    filename = generate_unique_filename(original_filename)
-    file_path = os.path.join(user_dir, filename)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(prefix=".upload.", suffix=".tmp", dir=user_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            copy_stream(stream, f, max_bytes=max_bytes, digest=digest)
 
-    with open(file_path, "wb") as f:
-        f.write(file_content)
+        filename = content_filename(digest.hexdigest(), original_filename)
+        file_path = os.path.join(user_dir, filename)
+        with _user_locks(user_id):
+            if os.path.exists(file_path):
+                # Restarts the orphan sweep's grace period
+                os.utime(file_path)
+            else:
+                os.replace(tmp_path, file_path)
+            _claim(user_id, filename)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-    # Return relative path from backend root
-    return os.path.join(USERS_DIR, user_id, filename).replace("\\", "/")
+    return _relative_path(user_id, filename)
+
+def file_content_hash(file_path: str) -> Optional[str]:
+    """SHA-256 of a stored file, read from its content-addressed name when possible"""
+    if not file_path:
+        return None
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    if _SHA256_HEX.match(stem):
+        return stem
+    if not os.path.isfile(file_path):
+        return None
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 def get_file_url(file_path: str) -> str:
     """Get URL to access the file"""
@@ -53,25 +143,128 @@ def delete_file(file_path: str) -> bool:
         pass
     return False
 
-def cleanup_user_files(user_id: str, keep_files: list = None) -> int:
-    """Delete user files not in keep_files list, return count of deleted files"""
-    if keep_files is None:
-        keep_files = []
+def _user_filenames(user_id: str, file_paths: Iterable[str]) -> List[str]:
+    """Filenames in the user's upload directory named by relative paths; other paths are ignored"""
+    prefix = _relative_path(user_id, "")
+    filenames = []
+    for relative_path in file_paths:
+        if not relative_path or not relative_path.startswith(prefix):
+            continue
+        filename = relative_path[len(prefix):]
+        if os.path.basename(filename) != filename or filename.startswith("."):
+            continue
+        filenames.append(filename)
+    return filenames
+
+def _claim(user_id: str, filename: str):
+    claim = _pending_uploads.setdefault((user_id, filename), [0, 0.0])
+    claim[0] += 1
+    claim[1] = time.time()
+
+def _unclaim(user_id: str, filename: str):
+    key = (user_id, filename)
+    claim = _pending_uploads.get(key)
+    if claim is None:
+        return
+    claim[0] -= 1
+    if claim[0] <= 0:
+        del _pending_uploads[key]
+
+def expire_upload_claims(user_id: str, max_age_seconds: float) -> int:
+    """
+    Forget the user's pending uploads claimed at least ``max_age_seconds`` ago, whose
+    requests are long over without a message referencing them. Returns count of claims dropped.
+    """
+    cutoff = time.time() - max_age_seconds
+    with _user_locks(user_id):
+        expired = [key for key, (_, claimed_at) in list(_pending_uploads.items()) if key[0] == user_id and claimed_at <= cutoff]
+        for key in expired:
+            del _pending_uploads[key]
+    return len(expired)
 
+def add_file_refs(user_id: str, file_paths: Iterable[str]):
+    """Count a reference for each stored file in ``file_paths`` (once per appended message referencing it)"""
     user_dir = os.path.join(USERS_DIR, user_id)
-    if not os.path.exists(user_dir):
+    filenames = [f for f in _user_filenames(user_id, file_paths) if os.path.exists(os.path.join(user_dir, f))]
+    if not filenames:
+        return
+    with _user_locks(user_id):
+        refs = _load_refs(user_dir)
+        for filename in filenames:
+            refs[filename] = refs.get(filename, 0) + 1
+            _unclaim(user_id, filename)
+        _save_refs(user_dir, refs)
+
+def _delete_unreferenced(user_dir: str, user_id: str, filename: str, refs: Dict[str, int]) -> bool:
+    if refs.get(filename, 0) > 0 or (user_id, filename) in _pending_uploads:
+        return False
+    refs.pop(filename, None)
+    return delete_file(os.path.join(user_dir, filename))
+
+def release_file_refs(user_id: str, file_paths: Iterable[str]) -> int:
+    """
+    Drop one reference for each of ``file_paths`` (relative paths, repeated once per removed
+    message) and delete files nothing references any more. Touches only these files.
+    Returns count of deleted files.
+    """
+    user_dir = os.path.join(USERS_DIR, user_id)
+    filenames = _user_filenames(user_id, file_paths)
+    if not filenames or not os.path.exists(user_dir):
         return 0
 
     deleted_count = 0
-    for filename in os.listdir(user_dir):
-        file_path = os.path.join(user_dir, filename)
-        relative_path = os.path.join(USERS_DIR, user_id, filename).replace("\\", "/")
-
-        if relative_path not in keep_files and os.path.isfile(file_path):
-            try:
-                os.remove(file_path)
+    with _user_locks(user_id):
+        refs = _load_refs(user_dir)
+        for filename in filenames:
+            if filename not in refs:
+                # Stored before the index: other messages may still reference it,
+                # so leave it to the orphan sweep, which recounts from history
+                continue
+            refs[filename] = max(refs[filename] - 1, 0)
+            if _delete_unreferenced(user_dir, user_id, filename, refs):
                 deleted_count += 1
-            except Exception:
-                pass
+        _save_refs(user_dir, refs)
+
+    return deleted_count
+
+def discard_upload(user_id: str, file_path: str) -> bool:
+    """Give back an upload whose request failed before any message referenced it; deletes it if unused"""
+    filenames = _user_filenames(user_id, [file_path])
+    if not filenames:
+        return False
+    user_dir = os.path.join(USERS_DIR, user_id)
+    with _user_locks(user_id):
+        _unclaim(user_id, filenames[0])
+        refs = _load_refs(user_dir)
+        return _delete_unreferenced(user_dir, user_id, filenames[0], refs)
 
-    return deleted_count
\ No newline at end of file
+def rebuild_file_refs(user_id: str, file_paths: Iterable[str]) -> List[str]:
+    """
+    Replace the user's index with counts of ``file_paths``, the file references of all their
+    stored messages, and return the stored files nothing references.
+    """
+    user_dir = os.path.join(USERS_DIR, user_id)
+    if not os.path.isdir(user_dir):
+        return []
+    counts = Counter(_user_filenames(user_id, file_paths))
+    with _user_locks(user_id):
+        stored = {entry.name for entry in os.scandir(user_dir) if entry.is_file() and not entry.name.startswith(".")}
+        refs = {filename: count for filename, count in counts.items() if filename in stored}
+        _save_refs(user_dir, refs)
+    return sorted(stored - refs.keys())
+
+def delete_orphan(user_id: str, filename: str, min_age_seconds: float = 0) -> bool:
+    """Delete a stored file if it is still unreferenced and was last uploaded at least ``min_age_seconds`` ago"""
+    user_dir = os.path.join(USERS_DIR, user_id)
+    with _user_locks(user_id):
+        try:
+            age = time.time() - os.path.getmtime(os.path.join(user_dir, filename))
+        except OSError:
+            return False
+        if age < min_age_seconds:
+            return False
+        refs = _load_refs(user_dir)
+        if not _delete_unreferenced(user_dir, user_id, filename, refs):
+            return False
+        _save_refs(user_dir, refs)
+        return True
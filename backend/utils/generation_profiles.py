@@ -0,0 +1,81 @@
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Tuple
+
+RADIOLOGIST_PROMPT = "You are an expert radiologist."
+
+
+@dataclass(frozen=True)
+class GenerationProfile:
+    """
+    Named generation settings. Decoding is always greedy, so answers stay deterministic
+    and cacheable; profiles trade answer length for latency.
+
+    ``deadline_seconds`` caps time spent generating: the answer is cut off where it
+    stands when the deadline passes, rather than failing the request.
+    """
+    name: str
+    system_prompt: str = RADIOLOGIST_PROMPT
+    max_new_tokens: int = 200
+    stop_strings: Tuple[str, ...] = field(default_factory=tuple)
+    deadline_seconds: Optional[float] = None
+
+    def cache_settings(self) -> Dict[str, Any]:
+        """Everything besides the deadline that determines the answer"""
+        return {
+            "profile": self.name,
+            "max_new_tokens": self.max_new_tokens,
+            "do_sample": False,
+            "stop_strings": list(self.stop_strings),
+        }
+
+    def generate_kwargs(self, tokenizer) -> Dict[str, Any]:
+        kwargs = {"max_new_tokens": self.max_new_tokens, "do_sample": False}
+        if self.stop_strings:
+            kwargs.update(stop_strings=list(self.stop_strings), tokenizer=tokenizer)
+        if self.deadline_seconds:
+            kwargs["max_time"] = self.deadline_seconds
+        return kwargs
+
+    def trim(self, answer: str) -> str:
+        """Drop the stop string generation ended on"""
+        for stop in self.stop_strings:
+            if answer.endswith(stop):
+                return answer[:-len(stop)]
+        return answer
+
+
+def _deadline(name: str, default: str) -> Optional[float]:
+    seconds = float(os.getenv(f"GENERATION_DEADLINE_{name.upper()}", default))
+    return seconds or None
+
+PROFILES: Dict[str, GenerationProfile] = {
+    profile.name: profile for profile in (
+        GenerationProfile("default", deadline_seconds=_deadline("default", "0")),
+        GenerationProfile(
+            "short",
+            system_prompt=f"{RADIOLOGIST_PROMPT} Answer in one or two sentences.",
+            max_new_tokens=64,
+            stop_strings=("\n\n",),
+            deadline_seconds=_deadline("short", "5"),
+        ),
+        GenerationProfile(
+            "detailed",
+            system_prompt=f"{RADIOLOGIST_PROMPT} Write a structured report with findings and an impression.",
+            max_new_tokens=512,
+            deadline_seconds=_deadline("detailed", "60"),
+        ),
+        GenerationProfile(
+            "triage",
+            system_prompt=(
+                f"{RADIOLOGIST_PROMPT} Triage the case: reply with the urgency "
+                "(emergent, urgent or routine) followed by a one-line reason."
+            ),
+            max_new_tokens=48,
+            stop_strings=("\n\n",),
+            deadline_seconds=_deadline("triage", "5"),
+        ),
+    )
+}
+DEFAULT_PROFILE = PROFILES["default"]
+PROFILE_PATTERN = f"^({'|'.join(PROFILES)})$"
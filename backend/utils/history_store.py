@@ -0,0 +1,516 @@
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.locks import StripedLock
+from utils.lru_cache import LRUCache
+from utils.metrics import timed
+
+CHAT_HISTORY_DIR = os.getenv("CHAT_HISTORY_DIR", "chat_history_db")
+CHAT_HISTORY_BACKEND = os.getenv("CHAT_HISTORY_BACKEND", "json")
+CHAT_HISTORY_DB = os.getenv("CHAT_HISTORY_DB", os.path.join(CHAT_HISTORY_DIR, "history.sqlite3"))
+# Parsed-history cache for the JSON backend; size is measured as serialized JSON bytes
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "1024"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor does not point into the listed collection"""
+
+
+def _page_before(items: List[Any], end: int, limit: int) -> Tuple[List[Any], int]:
+    start = max(0, end - limit)
+    return items[start:end], start
+
+
+class HistoryStore:
+    """
+    Storage interface for chat history.
+
+    A session is a dict with ``id``, ``title``, ``created_at`` and ``messages``;
+    messages are plain dicts as posted by the frontend.
+    """
+
+    _user_locks = StripedLock()
+
+    def user_lock(self, user_id: str) -> threading.RLock:
+        """Re-entrant lock serializing writes for one user; hold it around multi-step updates"""
+        return self._user_locks(user_id)
+
+    def load_sessions(self, user_id: str) -> List[Dict[str, Any]]:
+        """Return every session of a user, with messages, oldest first"""
+        raise NotImplementedError
+
+    def list_sessions(self, user_id: str) -> List[Dict[str, Any]]:
+        """Return id/title/created_at for every session of a user, oldest first"""
+        return [
+            {"id": s["id"], "title": s["title"], "created_at": s["created_at"]}
+            for s in self.load_sessions(user_id)
+        ]
+
+    def get_session(self, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def create_session(self, user_id: str, session: Dict[str, Any]):
+        raise NotImplementedError
+
+    def append_message(self, user_id: str, session_id: str, message: Dict[str, Any]) -> bool:
+        """Append a message to a session, return False if the session does not exist"""
+        raise NotImplementedError
+
+    def append_message_to_latest(self, user_id: str, message: Dict[str, Any], new_session: Dict[str, Any]):
+        """Append to the most recent session, creating ``new_session`` first if the user has none"""
+        raise NotImplementedError
+
+    def page_sessions(self, user_id: str, limit: int, before: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Return up to ``limit`` session summaries created before the session ``before``
+        (the most recent ones when None), oldest first, and the cursor of the next older page.
+        """
+        sessions = self.list_sessions(user_id)
+        end = len(sessions)
+        if before is not None:
+            ids = [s["id"] for s in sessions]
+            if before not in ids:
+                raise InvalidCursor(before)
+            end = ids.index(before)
+        page, start = _page_before(sessions, end, limit)
+        return page, page[0]["id"] if start > 0 else None
+
+    def page_messages(self, user_id: str, session_id: str, limit: int, before: Optional[str] = None) -> Optional[Tuple[List[Dict[str, Any]], Optional[str]]]:
+        """
+        Return up to ``limit`` messages of a session preceding the cursor ``before``
+        (the latest ones when None), oldest first, and the cursor of the next older page.
+        Returns None if the session does not exist.
+        """
+        session = self.get_session(user_id, session_id)
+        if session is None:
+            return None
+        messages = session.get("messages", [])
+        end = len(messages)
+        if before is not None:
+            if not before.isdigit() or int(before) > len(messages):
+                raise InvalidCursor(before)
+            end = int(before)
+        page, start = _page_before(messages, end, limit)
+        return page, str(start) if start > 0 else None
+
+    def count_messages(self, user_id: str, session_id: str) -> Optional[int]:
+        """Number of messages in a session, or None if it does not exist"""
+        session = self.get_session(user_id, session_id)
+        return None if session is None else len(session.get("messages", []))
+
+    def list_messages(self, user_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Return the messages of every session, flattened in session order, optionally only the last ``limit``"""
+        messages = [m for s in self.load_sessions(user_id) for m in s.get("messages", [])]
+        return messages[-limit:] if limit else messages
+
+    def delete_session(self, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+        """Delete a session and return it, or None if it does not exist"""
+        raise NotImplementedError
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of the store's read cache, empty if it has none"""
+        return {}
+
+
+class JSONHistoryStore(HistoryStore):
+    """
+    One pretty-printed JSON file per user holding the full list of sessions,
+    plus a compact session-summary index under ``_index/`` so listing sessions
+    never parses message bodies.
+
+    Parsed histories and summaries are kept in LRU caches that the write paths
+    update in place, so reads only touch disk on a cache miss. The caches assume
+    this process is the only writer of the directory.
+    """
+
+    def __init__(self, directory: str = CHAT_HISTORY_DIR, cache_max_users: int = HISTORY_CACHE_MAX_USERS, cache_max_bytes: int = HISTORY_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.index_directory = os.path.join(directory, "_index")
+        os.makedirs(self.index_directory, exist_ok=True)
+        self._cache = LRUCache(max_entries=cache_max_users, max_bytes=cache_max_bytes)
+        self._summary_cache = LRUCache(max_entries=cache_max_users, max_bytes=cache_max_bytes)
+
+    def get_history_path(self, user_id: str) -> str:
+        return os.path.join(self.directory, f"{user_id}.json")
+
+    def get_index_path(self, user_id: str) -> str:
+        return os.path.join(self.index_directory, f"{user_id}.json")
+
+    @staticmethod
+    def _summaries(sessions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [{"id": s["id"], "title": s["title"], "created_at": s["created_at"]} for s in sessions]
+
+    def _write_json(self, path: str, data: Any, indent: Optional[int] = None) -> int:
+        """Atomically replace ``path`` with ``data`` as JSON and return the written size"""
+        # Write to a temp file in the same directory and rename it over the old one,
+        # so a crash mid-write leaves the previous file intact
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=indent)
+                f.flush()
+                os.fsync(f.fileno())
+                size = os.fstat(f.fileno()).st_size
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return size
+
+    def list_sessions(self, user_id: str) -> List[Dict[str, Any]]:
+        summaries = self._summary_cache.get(user_id)
+        if summaries is not None:
+            return summaries
+        with self.user_lock(user_id):
+            if user_id in self._summary_cache:
+                return self._summary_cache.get(user_id)
+            history_path = self.get_history_path(user_id)
+            index_path = self.get_index_path(user_id)
+            if not os.path.exists(history_path):
+                return []
+            # Rebuild the index if it is missing or older than the history (e.g. after a crash between the two writes)
+            if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(history_path):
+                with timed("history_load"), open(index_path, "r", encoding="utf-8") as f:
+                    summaries = json.load(f)
+                    size = os.fstat(f.fileno()).st_size
+            else:
+                summaries = self._summaries(self.load_sessions(user_id))
+                size = self._write_json(index_path, summaries)
+            self._summary_cache.put(user_id, summaries, size=size)
+            return summaries
+
+    def load_sessions(self, user_id: str) -> List[Dict[str, Any]]:
+        """Return the user's sessions; the list is shared with the cache, so only mutate it under user_lock and save it"""
+        sessions = self._cache.get(user_id)
+        if sessions is not None:
+            return sessions
+        # Fill the cache under the user lock so a concurrent save cannot be overwritten by an older read
+        with self.user_lock(user_id):
+            if user_id in self._cache:
+                return self._cache.get(user_id)
+            path = self.get_history_path(user_id)
+            if not os.path.exists(path):
+                return []
+            with timed("history_load"), open(path, "r", encoding="utf-8") as f:
+                sessions = json.load(f)
+                size = os.fstat(f.fileno()).st_size
+            self._cache.put(user_id, sessions, size=size)
+            return sessions
+
+    @timed("history_save")
+    def save_sessions(self, user_id: str, sessions: List[Dict[str, Any]]):
+        with self.user_lock(user_id):
+            try:
+                size = self._write_json(self.get_history_path(user_id), sessions, indent=2)
+            except BaseException:
+                # The caller may have mutated a cached list that never reached disk
+                self._cache.pop(user_id)
+                raise
+            self._cache.put(user_id, sessions, size=size)
+
+            # Message appends leave the summaries unchanged, so the index is only rewritten on create/delete.
+            # Otherwise it is touched, so it stays no older than the history and cold reads keep trusting it
+            summaries = self._summaries(sessions)
+            index_path = self.get_index_path(user_id)
+            if summaries == self._summary_cache.get(user_id):
+                try:
+                    os.utime(index_path)
+                    return
+                except FileNotFoundError:
+                    pass
+            index_size = self._write_json(index_path, summaries)
+            self._summary_cache.put(user_id, summaries, size=index_size)
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+    def get_session(self, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+        for session in self.load_sessions(user_id):
+            if session["id"] == session_id:
+                return session
+        return None
+
+    # Every write is load -> mutate -> save, so it must hold the user lock
+    # for the whole cycle or concurrent requests lose each other's updates
+
+    def create_session(self, user_id: str, session: Dict[str, Any]):
+        with self.user_lock(user_id):
+            sessions = self.load_sessions(user_id)
+            sessions.append(session)
+            self.save_sessions(user_id, sessions)
+
+    def append_message(self, user_id: str, session_id: str, message: Dict[str, Any]) -> bool:
+        with self.user_lock(user_id):
+            sessions = self.load_sessions(user_id)
+            for session in sessions:
+                if session["id"] == session_id:
+                    session["messages"].append(message)
+                    self.save_sessions(user_id, sessions)
+                    return True
+        return False
+
+    def append_message_to_latest(self, user_id: str, message: Dict[str, Any], new_session: Dict[str, Any]):
+        with self.user_lock(user_id):
+            sessions = self.load_sessions(user_id)
+            if not sessions:
+                sessions.append(new_session)
+            sessions[-1]["messages"].append(message)
+            self.save_sessions(user_id, sessions)
+
+    def delete_session(self, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+        with self.user_lock(user_id):
+            sessions = self.load_sessions(user_id)
+            for i, session in enumerate(sessions):
+                if session["id"] == session_id:
+                    del sessions[i]
+                    self.save_sessions(user_id, sessions)
+                    return session
+        return None
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    SQLite database in WAL mode with indexed sessions and messages tables.
+    Appending a message is a single indexed insert regardless of history size.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            pk INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            UNIQUE (user_id, session_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id, pk);
+        CREATE TABLE IF NOT EXISTS messages (
+            pk INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_pk INTEGER NOT NULL REFERENCES sessions (pk) ON DELETE CASCADE,
+            file_path TEXT,
+            body TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_pk, pk);
+    """
+
+    def __init__(self, db_path: str = CHAT_HISTORY_DB):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._connect().executescript(self.SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections are not shared across threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _session_dict(row, messages: List[Dict[str, Any]] = None) -> Dict[str, Any]:
+        session = {"id": row[0], "title": row[1], "created_at": row[2]}
+        if messages is not None:
+            session["messages"] = messages
+        return session
+
+    def _session_pk(self, conn: sqlite3.Connection, user_id: str, session_id: str) -> Optional[int]:
+        row = conn.execute(
+            "SELECT pk FROM sessions WHERE user_id = ? AND session_id = ?", (user_id, session_id)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _messages(self, conn: sqlite3.Connection, session_pk: int) -> List[Dict[str, Any]]:
+        rows = conn.execute("SELECT body FROM messages WHERE session_pk = ? ORDER BY pk", (session_pk,))
+        return [json.loads(body) for (body,) in rows]
+
+    def _insert_session(self, conn: sqlite3.Connection, user_id: str, session: Dict[str, Any]) -> int:
+        cursor = conn.execute(
+            "INSERT INTO sessions (user_id, session_id, title, created_at) VALUES (?, ?, ?, ?)",
+            (user_id, session["id"], session["title"], session["created_at"])
+        )
+        for message in session.get("messages", []):
+            self._insert_message(conn, cursor.lastrowid, message)
+        return cursor.lastrowid
+
+    @staticmethod
+    def _insert_message(conn: sqlite3.Connection, session_pk: int, message: Dict[str, Any]):
+        conn.execute(
+            "INSERT INTO messages (session_pk, file_path, body) VALUES (?, ?, ?)",
+            (session_pk, message.get("filePath"), json.dumps(message, ensure_ascii=False))
+        )
+
+    @timed("history_load")
+    def load_sessions(self, user_id: str) -> List[Dict[str, Any]]:
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT session_id, title, created_at, pk FROM sessions WHERE user_id = ? ORDER BY pk", (user_id,)
+        ).fetchall()
+        return [self._session_dict(row, self._messages(conn, row[3])) for row in rows]
+
+    @timed("history_load")
+    def list_sessions(self, user_id: str) -> List[Dict[str, Any]]:
+        rows = self._connect().execute(
+            "SELECT session_id, title, created_at FROM sessions WHERE user_id = ? ORDER BY pk", (user_id,)
+        )
+        return [self._session_dict(row) for row in rows]
+
+    @timed("history_load")
+    def get_session(self, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT session_id, title, created_at, pk FROM sessions WHERE user_id = ? AND session_id = ?",
+            (user_id, session_id)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._session_dict(row, self._messages(conn, row[3]))
+
+    @timed("history_save")
+    def create_session(self, user_id: str, session: Dict[str, Any]):
+        conn = self._connect()
+        with conn:
+            self._insert_session(conn, user_id, session)
+
+    @timed("history_save")
+    def append_message(self, user_id: str, session_id: str, message: Dict[str, Any]) -> bool:
+        conn = self._connect()
+        with conn:
+            session_pk = self._session_pk(conn, user_id, session_id)
+            if session_pk is None:
+                return False
+            self._insert_message(conn, session_pk, message)
+        return True
+
+    @timed("history_save")
+    def append_message_to_latest(self, user_id: str, message: Dict[str, Any], new_session: Dict[str, Any]):
+        conn = self._connect()
+        with conn:
+            row = conn.execute(
+                "SELECT pk FROM sessions WHERE user_id = ? ORDER BY pk DESC LIMIT 1", (user_id,)
+            ).fetchone()
+            session_pk = row[0] if row else self._insert_session(conn, user_id, new_session)
+            self._insert_message(conn, session_pk, message)
+
+    @timed("history_load")
+    def page_sessions(self, user_id: str, limit: int, before: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        conn = self._connect()
+        before_pk = None
+        if before is not None:
+            before_pk = self._session_pk(conn, user_id, before)
+            if before_pk is None:
+                raise InvalidCursor(before)
+        # Fetch one extra row to learn whether an older page exists
+        rows = conn.execute(
+            "SELECT session_id, title, created_at FROM sessions WHERE user_id = ? AND pk < ? "
+            "ORDER BY pk DESC LIMIT ?", (user_id, before_pk if before_pk is not None else sys.maxsize, limit + 1)
+        ).fetchall()
+        page = [self._session_dict(row) for row in reversed(rows[:limit])]
+        return page, page[0]["id"] if len(rows) > limit else None
+
+    @timed("history_load")
+    def page_messages(self, user_id: str, session_id: str, limit: int, before: Optional[str] = None) -> Optional[Tuple[List[Dict[str, Any]], Optional[str]]]:
+        # Message cursors are row ids, so each page is one range scan on idx_messages_session
+        if before is not None and not before.isdigit():
+            raise InvalidCursor(before)
+        conn = self._connect()
+        session_pk = self._session_pk(conn, user_id, session_id)
+        if session_pk is None:
+            return None
+        rows = conn.execute(
+            "SELECT pk, body FROM messages WHERE session_pk = ? AND pk < ? ORDER BY pk DESC LIMIT ?",
+            (session_pk, int(before) if before is not None else sys.maxsize, limit + 1)
+        ).fetchall()
+        page = list(reversed(rows[:limit]))
+        next_before = str(page[0][0]) if len(rows) > limit else None
+        return [json.loads(body) for _, body in page], next_before
+
+    def count_messages(self, user_id: str, session_id: str) -> Optional[int]:
+        conn = self._connect()
+        session_pk = self._session_pk(conn, user_id, session_id)
+        if session_pk is None:
+            return None
+        return conn.execute("SELECT COUNT(*) FROM messages WHERE session_pk = ?", (session_pk,)).fetchone()[0]
+
+    @timed("history_load")
+    def list_messages(self, user_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        if limit:
+            rows = self._connect().execute(
+                "SELECT m.body FROM messages m JOIN sessions s ON s.pk = m.session_pk "
+                "WHERE s.user_id = ? ORDER BY s.pk DESC, m.pk DESC LIMIT ?", (user_id, limit)
+            ).fetchall()
+            return [json.loads(body) for (body,) in reversed(rows)]
+        rows = self._connect().execute(
+            "SELECT m.body FROM messages m JOIN sessions s ON s.pk = m.session_pk "
+            "WHERE s.user_id = ? ORDER BY s.pk, m.pk", (user_id,)
+        )
+        return [json.loads(body) for (body,) in rows]
+
+    @timed("history_save")
+    def delete_session(self, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        with conn:
+            session = self.get_session(user_id, session_id)
+            if session is None:
+                return None
+            conn.execute("DELETE FROM sessions WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+        return session
+
+    def has_user(self, user_id: str) -> bool:
+        row = self._connect().execute("SELECT 1 FROM sessions WHERE user_id = ? LIMIT 1", (user_id,)).fetchone()
+        return row is not None
+
+
+def create_history_store(backend: str = CHAT_HISTORY_BACKEND) -> HistoryStore:
+    """Build the history store selected by CHAT_HISTORY_BACKEND ("json" or "sqlite")"""
+    if backend == "json":
+        return JSONHistoryStore(CHAT_HISTORY_DIR)
+    if backend == "sqlite":
+        return SQLiteHistoryStore(CHAT_HISTORY_DB)
+    raise ValueError(f"Unknown chat history backend: {backend}")
+
+
+def migrate_json_to_sqlite(json_dir: str = CHAT_HISTORY_DIR, db_path: str = CHAT_HISTORY_DB) -> Dict[str, int]:
+    """
+    One-shot import of every {user_id}.json history file into the SQLite store.
+    Users that already have rows in the database are skipped, so re-running is safe.
+    Migrated files are renamed to {user_id}.json.migrated. Returns sessions imported per user.
+    """
+    source = JSONHistoryStore(json_dir)
+    target = SQLiteHistoryStore(db_path)
+    conn = target._connect()
+    migrated = {}
+    for filename in sorted(os.listdir(json_dir)):
+        if not filename.endswith(".json"):
+            continue
+        user_id = filename[:-len(".json")]
+        if target.has_user(user_id):
+            continue
+        sessions = source.load_sessions(user_id)
+        with conn:
+            for session in sessions:
+                target._insert_session(conn, user_id, session)
+        path = source.get_history_path(user_id)
+        os.replace(path, path + ".migrated")
+        migrated[user_id] = len(sessions)
+    return migrated
+
+
+if __name__ == "__main__":
+    # python -m utils.history_store migrate [json_dir] [db_path]
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        sys.exit("usage: python -m utils.history_store migrate [json_dir] [db_path]")
+    result = migrate_json_to_sqlite(*sys.argv[2:4])
+    print(f"Migrated {sum(result.values())} sessions for {len(result)} users")
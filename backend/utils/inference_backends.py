@@ -0,0 +1,236 @@
+import os
+import io
+import json
+import time
+import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from utils.answer_cache import image_hash
+from utils.generation_profiles import DEFAULT_PROFILE, GenerationProfile
+
+# Which backend answers VLM queries: transformers (in-process, GPU when available),
+# cpu-int8 (in-process, dynamically quantized for CPU nodes), remote (an OpenAI-compatible
+# server such as vLLM or TGI) or fake (deterministic canned answers, for tests)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "transformers")
+MODEL_ID = os.getenv("MODEL_ID", "google/medgemma-4b-it")
+
+REMOTE_INFERENCE_URL = os.getenv("REMOTE_INFERENCE_URL", "http://localhost:8001")
+REMOTE_INFERENCE_API_KEY = os.getenv("REMOTE_INFERENCE_API_KEY", "")
+REMOTE_INFERENCE_TIMEOUT = float(os.getenv("REMOTE_INFERENCE_TIMEOUT", "120"))
+# Requests of one batch sent to the server at once; the server does its own batching
+REMOTE_INFERENCE_CONCURRENCY = int(os.getenv("REMOTE_INFERENCE_CONCURRENCY", "8"))
+
+# Simulated generation time per word of a fake answer
+FAKE_INFERENCE_DELAY_MS = float(os.getenv("FAKE_INFERENCE_DELAY_MS", "0"))
+
+# on_text receives each decoded chunk as it is generated; should_stop is polled to cancel
+TextCallback = Optional[Callable[[str], None]]
+StopCheck = Optional[Callable[[], bool]]
+# One generate_batch request: (image, query, earlier session turns, session key)
+BatchRequest = Tuple[Optional[Image.Image], str, Sequence[Dict[str, str]], Optional[Tuple[str, str]]]
+
+
+def build_messages(image: Image.Image = None, query: str = "", history: Sequence[Dict[str, str]] = (),
+                   system_prompt: str = DEFAULT_PROFILE.system_prompt) -> List[Dict[str, Any]]:
+    """``history`` holds earlier {"role", "text"} turns of the session (see utils.conversation)"""
+    user_content = [{"type": "text", "text": query}]
+    if image:
+        user_content.append({"type": "image", "image": image})
+
+    return [
+        {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
+        *({"role": turn["role"], "content": [{"type": "text", "text": turn["text"]}]} for turn in history),
+        {"role": "user", "content": user_content}
+    ]
+
+
+class InferenceBackend:
+    """
+    Where answers are generated. Methods are blocking and run on the inference executor.
+
+    ``generate_batch`` answers independent requests, each with its own session history,
+    under one profile; ``generate_turn`` answers one question in the context of earlier
+    session turns, reporting text through ``on_text`` as it is produced. Both return
+    (answer, complete) where complete is False when generation was cut off by the deadline
+    or should_stop. ``reuses_session`` tells callers when generate_turn can resume the
+    session's cached state and is worth taking a request out of the batch for.
+    """
+    name = "base"
+    # How the weights are quantized, if at all; answers differ between quantization modes
+    quantization = "none"
+
+    def __init__(self, model_id: str = MODEL_ID):
+        self.model_id = model_id
+
+    def load(self):
+        """Prepare the backend; raises when it cannot serve"""
+
+    def image_input_size(self, default: int = 896) -> int:
+        """Longest side, in pixels, of the images the model looks at"""
+        return default
+
+    def generate_batch(self, requests: Sequence[BatchRequest],
+                       profile: GenerationProfile = DEFAULT_PROFILE) -> List[Tuple[str, bool]]:
+        return [self.generate_turn(image, query, history, session_key, profile) for image, query, history, session_key in requests]
+
+    def reuses_session(self, image: Optional[Image.Image], history: Sequence[Dict[str, str]],
+                       session_key: Optional[Tuple[str, str]]) -> bool:
+        return False
+
+    def generate_turn(self, image: Image.Image = None, query: str = "", history: Sequence[Dict[str, str]] = (),
+                      session_key: Optional[Tuple[str, str]] = None, profile: GenerationProfile = DEFAULT_PROFILE,
+                      on_text: TextCallback = None, should_stop: StopCheck = None) -> Tuple[str, bool]:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters of backend-side caches, keyed by cache name"""
+        return {}
+
+
+class FakeBackend(InferenceBackend):
+    """
+    Deterministic answers derived from the prompt and image, without a model.
+    The same question always gets the same answer, so caching and batching
+    behave as they do with a real greedy model.
+    """
+    name = "fake"
+
+    def __init__(self, model_id: str = "fake", delay_ms: float = FAKE_INFERENCE_DELAY_MS):
+        super().__init__(model_id)
+        self.delay = delay_ms / 1000.0
+
+    def answer(self, image: Optional[Image.Image], query: str, history: Sequence[Dict[str, str]],
+               profile: GenerationProfile) -> str:
+        digest = hashlib.sha256(json.dumps([profile.system_prompt, list(history), query, image_hash(image)]).encode("utf-8"))
+        subject = "the image" if image is not None else "the question"
+        words = f"Finding {digest.hexdigest()[:8]} for {subject}: {query}".split()
+        return " ".join(words[:profile.max_new_tokens])
+
+    def generate_batch(self, requests: Sequence[BatchRequest],
+                       profile: GenerationProfile = DEFAULT_PROFILE) -> List[Tuple[str, bool]]:
+        """Pays the delay once per word for the whole batch, as one batched generate steps every sequence together"""
+        answers = [self.answer(image, query, history, profile).split(" ") for image, query, history, _ in requests]
+        started = time.monotonic()
+        steps = max((len(words) for words in answers), default=0)
+        for step in range(steps):
+            if profile.deadline_seconds and time.monotonic() - started >= profile.deadline_seconds:
+                steps = step
+                break
+            if self.delay:
+                time.sleep(self.delay)
+        return [(" ".join(words[:steps]), steps >= len(words)) for words in answers]
+
+    def generate_turn(self, image: Image.Image = None, query: str = "", history: Sequence[Dict[str, str]] = (),
+                      session_key: Optional[Tuple[str, str]] = None, profile: GenerationProfile = DEFAULT_PROFILE,
+                      on_text: TextCallback = None, should_stop: StopCheck = None) -> Tuple[str, bool]:
+        started = time.monotonic()
+        produced = []
+        for i, word in enumerate(self.answer(image, query, history, profile).split(" ")):
+            if should_stop is not None and should_stop():
+                return " ".join(produced), False
+            if profile.deadline_seconds and time.monotonic() - started >= profile.deadline_seconds:
+                return " ".join(produced), False
+            if self.delay:
+                time.sleep(self.delay)
+            produced.append(word)
+            if on_text is not None:
+                on_text(word if i == 0 else " " + word)
+        return " ".join(produced), True
+
+
+def _image_data_url(image: Image.Image) -> str:
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class RemoteBackend(InferenceBackend):
+    """
+    Generation on a separate inference server speaking the OpenAI chat completions API
+    (vLLM, TGI and llama.cpp servers all do), so model capacity scales apart from the API
+    workers. Responses are always streamed, which lets deadlines and cancellation keep
+    the part of the answer produced so far.
+    """
+    name = "remote"
+
+    def __init__(self, model_id: str = MODEL_ID, base_url: str = REMOTE_INFERENCE_URL,
+                 api_key: str = REMOTE_INFERENCE_API_KEY, timeout: float = REMOTE_INFERENCE_TIMEOUT,
+                 concurrency: int = REMOTE_INFERENCE_CONCURRENCY):
+        super().__init__(model_id)
+        import httpx
+
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self._client = httpx.Client(base_url=base_url.rstrip("/"), headers=headers, timeout=timeout)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="remote-inference")
+
+    def load(self):
+        # Fails fast when the server is unreachable; model loading is retried on the next request
+        self._client.get("/v1/models").raise_for_status()
+
+    def _payload(self, image: Optional[Image.Image], query: str, history: Sequence[Dict[str, str]],
+                 profile: GenerationProfile) -> Dict[str, Any]:
+        messages = []
+        for message in build_messages(image, query, history, profile.system_prompt):
+            content = [
+                {"type": "image_url", "image_url": {"url": _image_data_url(part["image"])}} if part["type"] == "image" else part
+                for part in message["content"]
+            ]
+            messages.append({"role": message["role"], "content": content})
+        payload = {
+            "model": self.model_id,
+            "messages": messages,
+            "max_tokens": profile.max_new_tokens,
+            "temperature": 0,
+            "stream": True,
+        }
+        if profile.stop_strings:
+            payload["stop"] = list(profile.stop_strings)
+        return payload
+
+    def generate_turn(self, image: Image.Image = None, query: str = "", history: Sequence[Dict[str, str]] = (),
+                      session_key: Optional[Tuple[str, str]] = None, profile: GenerationProfile = DEFAULT_PROFILE,
+                      on_text: TextCallback = None, should_stop: StopCheck = None) -> Tuple[str, bool]:
+        started = time.monotonic()
+        chunks = []
+        with self._client.stream("POST", "/v1/chat/completions", json=self._payload(image, query, history, profile)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                text = (choices[0].get("delta") or {}).get("content") or ""
+                if text:
+                    chunks.append(text)
+                    if on_text is not None:
+                        on_text(text)
+                # Closing the response stops generation on the server
+                if should_stop is not None and should_stop():
+                    return "".join(chunks), False
+                if profile.deadline_seconds and time.monotonic() - started >= profile.deadline_seconds:
+                    return "".join(chunks), False
+        return profile.trim("".join(chunks)), True
+
+    def generate_batch(self, requests: Sequence[BatchRequest],
+                       profile: GenerationProfile = DEFAULT_PROFILE) -> List[Tuple[str, bool]]:
+        futures = [self._pool.submit(self.generate_turn, image, query, history, session_key, profile)
+                   for image, query, history, session_key in requests]
+        return [future.result() for future in futures]
+
+
+def create_backend(name: str = INFERENCE_BACKEND) -> InferenceBackend:
+    if name == "fake":
+        return FakeBackend()
+    if name == "remote":
+        return RemoteBackend()
+    if name in ("transformers", "cpu-int8"):
+        from utils.transformers_backend import TransformersBackend
+
+        return TransformersBackend(quantize_int8=name == "cpu-int8")
+    raise ValueError(f"Unknown INFERENCE_BACKEND {name!r}, expected transformers, cpu-int8, remote or fake")
@@ -0,0 +1,60 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "8"))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "32"))
+
+
+class InferenceQueueFull(Exception):
+    """Raised when a job is submitted while every worker and queue slot is taken"""
+
+
+class InferenceExecutor:
+    """Dedicated thread pool for model work with a bounded admission queue.
+
+    At most ``max_workers`` jobs run at once and at most ``max_queue`` more wait
+    for a worker; anything beyond that is rejected immediately instead of piling
+    up behind the model.
+    """
+
+    def __init__(self, max_workers: int = INFERENCE_WORKERS, max_queue: int = INFERENCE_QUEUE_SIZE):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+        self._lock = threading.Lock()
+        self._admitted = 0
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if not self._slots.acquire(blocking=False):
+            raise InferenceQueueFull("Inference queue is full")
+        with self._lock:
+            self._admitted += 1
+        try:
+            future = self._pool.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _release(self):
+        with self._lock:
+            self._admitted -= 1
+        self._slots.release()
+
+    def in_flight(self) -> int:
+        """Number of admitted jobs, running or waiting for a worker"""
+        return self._admitted
+
+    def is_full(self) -> bool:
+        return self._admitted >= self.max_workers + self.max_queue
+
+
+inference_executor = InferenceExecutor()
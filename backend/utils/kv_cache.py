@@ -0,0 +1,134 @@
+import os
+import copy
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+from utils.lru_cache import LRUCache
+
+# Per-session KV caches of the previous turn, bounded by count and by memory
+KV_CACHE_MAX_SESSIONS = int(os.getenv("KV_CACHE_MAX_SESSIONS", "64"))
+KV_CACHE_MAX_BYTES = int(os.getenv("KV_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+def _layer_tensors(cache: Any) -> List[Tuple[Any, Any]]:
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        return [(getattr(layer, "keys", None), getattr(layer, "values", None)) for layer in layers]
+    return list(zip(getattr(cache, "key_cache", []), getattr(cache, "value_cache", [])))
+
+def cache_nbytes(cache: Any) -> int:
+    """Memory held by a transformers Cache object's key/value tensors"""
+    tensors = [t for pair in _layer_tensors(cache) for t in pair]
+    return sum(t.numel() * t.element_size() for t in tensors if hasattr(t, "numel"))
+
+def split_cache_row(cache: Any, row: int, start: int, target: Any) -> Optional[Any]:
+    """
+    Copy one sequence of a batched cache, from position ``start`` on (past its left padding),
+    into the empty cache ``target``. None when some layer does not hold every position,
+    as a sliding-window layer past its window does.
+    """
+    length = cache.get_seq_length()
+    pairs = _layer_tensors(cache)
+    if not pairs or any(not hasattr(keys, "shape") or keys.shape[-2] != length for keys, _ in pairs):
+        return None
+    for layer_idx, (keys, values) in enumerate(pairs):
+        target.update(keys[row:row + 1, :, start:].clone(), values[row:row + 1, :, start:].clone(), layer_idx)
+    return target
+
+
+class SessionKVCache:
+    """
+    KV caches for multi-turn generation, so each turn only prefills its new tokens.
+
+    Each session keeps the cache of its last turn together with the token ids it covers.
+    ``take`` hands it out exclusively, cropped to the longest prefix shared with the new
+    prompt; ``store`` puts the grown cache back after generation. Caches of the shared
+    system-prompt prefixes (one per prompt) seed sessions that have none. Sessions are
+    evicted LRU by memory.
+    """
+
+    def __init__(self, max_sessions: int = KV_CACHE_MAX_SESSIONS, max_bytes: int = KV_CACHE_MAX_BYTES):
+        self.enabled = max_sessions > 0 and max_bytes > 0
+        self._sessions = LRUCache(max_entries=max_sessions, max_bytes=max_bytes)
+        self._prefixes: Dict[str, Tuple[List[int], Any]] = {}
+        self.prefix_lock = threading.Lock()
+        self.session_hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    def has_session(self, session_key: Optional[Hashable]) -> bool:
+        return self.enabled and session_key is not None and session_key in self._sessions
+
+    def has_prefix(self, name: str) -> bool:
+        return name in self._prefixes
+
+    def set_prefix(self, name: str, tokens: List[int], cache: Any):
+        self._prefixes[name] = (tokens, cache)
+
+    def take(self, session_key: Optional[Hashable], input_ids: List[int]) -> Tuple[Optional[Any], int]:
+        """Return (cache, reused token count) for a prompt, or (None, 0) when nothing can be reused"""
+        session = self._sessions.pop(session_key) if session_key is not None else None
+        candidates = []
+        if session is not None:
+            candidates.append((common_prefix_length(session[0], input_ids), session[1], False))
+        for tokens, cache in list(self._prefixes.values()):
+            candidates.append((common_prefix_length(tokens, input_ids), cache, True))
+
+        # At least one prompt token must be left to run through the model
+        for length, cache, shared in sorted(candidates, key=lambda c: c[0], reverse=True):
+            length = min(length, len(input_ids) - 1)
+            if length <= 0:
+                continue
+            if shared:
+                cache = copy.deepcopy(cache)
+            try:
+                excess = cache.get_seq_length() - length
+                if excess > 0:
+                    cache.crop(-excess)
+            except Exception:
+                # Cache type cannot be truncated (e.g. a rolled sliding window)
+                continue
+            if shared:
+                self.prefix_hits += 1
+            else:
+                self.session_hits += 1
+            self.reused_tokens += length
+            self.prefilled_tokens += len(input_ids) - length
+            return cache, length
+
+        self.misses += 1
+        self.prefilled_tokens += len(input_ids)
+        return None, 0
+
+    def store(self, session_key: Hashable, tokens: List[int], cache: Any):
+        self._sessions.put(session_key, (tokens, cache), size=cache_nbytes(cache))
+
+    def drop(self, session_key: Hashable):
+        self._sessions.pop(session_key)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self._sessions.stats()
+        stats.update(
+            session_hits=self.session_hits,
+            prefix_hits=self.prefix_hits,
+            misses=self.misses,
+            reused_tokens=self.reused_tokens,
+            prefilled_tokens=self.prefilled_tokens,
+        )
+        lookups = self.session_hits + self.prefix_hits + self.misses
+        stats["hit_rate"] = (self.session_hits + self.prefix_hits) / lookups if lookups else 0.0
+        del stats["hits"]
+        return stats
+
+
+session_kv_cache = SessionKVCache()
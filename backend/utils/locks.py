@@ -0,0 +1,18 @@
+import threading
+import zlib
+
+
+class StripedLock:
+    """
+    Fixed pool of re-entrant locks indexed by key hash.
+
+    Gives per-key mutual exclusion (e.g. per user) without keeping one lock
+    object alive for every key ever seen. Two keys may share a stripe, which
+    only costs some unnecessary waiting, never correctness.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.RLock() for _ in range(max(1, stripes))]
+
+    def __call__(self, key: str) -> threading.RLock:
+        return self._locks[zlib.crc32(key.encode("utf-8")) % len(self._locks)]
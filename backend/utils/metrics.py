@@ -0,0 +1,336 @@
+import os
+import re
+import sys
+import time
+import bisect
+import asyncio
+import threading
+from collections import Counter as _Tally
+from contextlib import ContextDecorator
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from cache hits up to long generations
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Per-request sampling profiles, requested with the PROFILE_HEADER request header.
+# Off unless PROFILING_ENABLED, since a profile exposes code paths and costs CPU
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_HEADER = "X-Profile"
+PROFILE_FILE_HEADER = "X-Profile-File"
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, in the Prometheus model"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Bucket counts (last one is +Inf), sum, count
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Tuple[List[int], float, int]]:
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+
+    def render(self) -> List[str]:
+        lines = []
+        for label_values, (counts, total, count) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter per label set"""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values: str):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class GaugeCallback:
+    """Gauge read at scrape time; ``fn`` returns {label values: value}"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str], fn: Callable[[], Dict[Tuple[str, ...], float]]):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            values = sorted(self.fn().items())
+        except Exception:
+            return []
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values if value is not None]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics.values():
+            body = metric.render()
+            if not body:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(body)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "Time from request to the end of the response body, per route",
+    labels=("method", "route", "status"),
+))
+stage_duration = registry.register(Histogram(
+    "stage_duration_seconds", "Time spent in one processing stage",
+    labels=("stage",),
+))
+generated_tokens = registry.register(Counter(
+    "generated_tokens_total", "Tokens produced by generate: the first of each sequence by prefill, the rest by decode",
+    labels=("phase",),
+))
+decode_throughput = registry.register(Histogram(
+    "decode_tokens_per_second", "Decode throughput of one generate call, over all sequences of its batch",
+    buckets=THROUGHPUT_BUCKETS,
+))
+
+
+def observe_stage(stage: str, seconds: float):
+    stage_duration.observe(seconds, stage)
+
+
+class timed(ContextDecorator):
+    """Record the duration of a block, or of every call of a decorated function, as a stage"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self._started = threading.local()
+
+    def __enter__(self):
+        starts = getattr(self._started, "stack", None)
+        if starts is None:
+            starts = self._started.stack = []
+        starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc):
+        stage_duration.observe(time.perf_counter() - self._started.stack.pop(), self.stage)
+        return False
+
+
+def register_gauge(name: str, help: str, labels: Sequence[str], fn: Callable[[], Dict[Tuple[str, ...], float]]):
+    registry.register(GaugeCallback(name, help, labels, fn))
+
+def register_queue_depths(fn: Callable[[], Dict[str, int]]):
+    """``fn`` returns {queue name: items waiting or running}"""
+    register_gauge(
+        "queue_depth", "Jobs admitted to a queue and not yet finished", ("queue",),
+        lambda: {(name,): depth for name, depth in fn().items()},
+    )
+
+def register_cache_stats(fn: Callable[[], Dict[str, Dict[str, Any]]]):
+    """``fn`` returns {cache name: stats dict} as the caches' ``stats()`` methods report them"""
+    fields = (
+        ("hits", "cache_hits", "Lookups served from the cache"),
+        ("misses", "cache_misses", "Lookups the cache could not serve"),
+        ("hit_rate", "cache_hit_ratio", "Hits over lookups since start"),
+        ("entries", "cache_entries", "Entries held"),
+        ("bytes", "cache_bytes", "Bytes held"),
+        ("evictions", "cache_evictions", "Entries evicted by size or count"),
+    )
+    for field, name, help in fields:
+        register_gauge(
+            name, help, ("cache",),
+            lambda field=field: {(cache,): stats.get(field) for cache, stats in fn().items()},
+        )
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampler of every thread's Python stack, for profiling one request
+    including the executor threads it hands work to. Samples are written in the
+    collapsed-stack format read by flamegraph.pl and speedscope, one line per
+    distinct stack prefixed with the thread name. One profile runs at a time.
+    """
+    _busy = threading.Lock()
+
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000.0
+        self.samples = _Tally()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> bool:
+        if not self._busy.acquire(blocking=False):
+            return False
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[";".join([names.get(ident, str(ident))] + stack[::-1])] += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._busy.release()
+
+    def write(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every request into http_request_duration_seconds, labelled by
+    route template so path parameters do not multiply series. Streaming responses are
+    timed to their last byte.
+
+    With profiling enabled, a request carrying ``X-Profile: 1`` is sampled while it runs;
+    the profile path comes back in ``X-Profile-File``.
+    """
+
+    def __init__(self, app, profiling: bool = PROFILING_ENABLED):
+        self.app = app
+        self.profiling = profiling
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = [500]
+        profiler = profile_path = None
+        if self.profiling and _header(scope, PROFILE_HEADER.lower().encode()) in (b"1", b"true"):
+            profiler = SamplingProfiler()
+            if profiler.start():
+                profile_path = _profile_path(scope)
+            else:
+                profiler = None
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if profiler is not None:
+                    # Announced up front; the file is written once the response has ended
+                    message["headers"] = list(message.get("headers", [])) + [(PROFILE_FILE_HEADER.lower().encode(), profile_path.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_duration.observe(time.perf_counter() - started, scope.get("method", ""), _route_template(scope), str(status[0]))
+            if profiler is not None:
+                # Joining the sampler thread and writing the file block, so not on the event loop;
+                # the thread finishes the profile even if this request is cancelled meanwhile
+                await asyncio.to_thread(_save_profile, profiler, profile_path)
+
+
+def _save_profile(profiler: SamplingProfiler, path: str):
+    profiler.stop()
+    profiler.write(path)
+
+
+def _route_template(scope) -> str:
+    route = scope.get("route")
+    template = getattr(route, "path", None)
+    if template is None:
+        return "unmatched"
+    # Routes of included routers may carry their path without the router's prefix;
+    # recover the prefix from what the template matched at the end of the request path
+    path = scope.get("path", "")
+    try:
+        matched = getattr(route, "path_format", template).format(**scope.get("path_params", {}))
+    except (KeyError, IndexError, ValueError):
+        return template
+    if matched != path and path.endswith(matched):
+        return path[:len(path) - len(matched)] + template
+    return template
+
+def _header(scope, name: bytes) -> Optional[bytes]:
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.strip().lower()
+    return None
+
+def _profile_path(scope) -> str:
+    label = re.sub(r"[^A-Za-z0-9_.-]+", "_", f"{scope.get('method', '')}-{scope.get('path', '')}").strip("_")
+    return os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{time.perf_counter_ns() % 10**6:06d}-{label}.folded")
@@ -0,0 +1,67 @@
+import json
+import uuid
+from typing import Dict, Iterator, Optional
+
+from fastapi.responses import StreamingResponse
+
+from utils.pdf_render import IMAGE_FORMATS
+
+# json: one JSON array of base64 images (built in memory)
+# ndjson: one {"page", "format", "image"} base64 object per line, streamed as pages convert
+# multipart: raw image bytes, one multipart/mixed part per page, streamed as pages convert
+RESPONSE_MODES = ("json", "ndjson", "multipart")
+RESPONSE_MODE_PATTERN = f"^({'|'.join(RESPONSE_MODES)})$"
+IMAGE_FORMAT_PATTERN = f"^({'|'.join(IMAGE_FORMATS)})$"
+
+
+def prefetch_first(items: Iterator) -> Iterator:
+    """
+    Produce the first item now, so a bad document or a full conversion queue
+    becomes an ordinary error response instead of a stream cut off after the headers.
+    """
+    try:
+        first = next(items)
+    except StopIteration:
+        return iter(())
+    return _chain_first(first, items)
+
+def _chain_first(first, items: Iterator) -> Iterator:
+    try:
+        yield first
+        yield from items
+    finally:
+        close = getattr(items, "close", None)
+        if close:
+            close()
+
+def ndjson_pages(pages: Iterator[str], image_format: str) -> Iterator[bytes]:
+    for number, image in enumerate(pages, start=1):
+        yield (json.dumps({"page": number, "format": image_format, "image": image}) + "\n").encode("utf-8")
+
+def multipart_pages(pages: Iterator[bytes], image_format: str, boundary: str) -> Iterator[bytes]:
+    media_type = IMAGE_FORMATS[image_format][1]
+    for number, image in enumerate(pages, start=1):
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {media_type}\r\n"
+            f'Content-Disposition: inline; name="page"; filename="page-{number}.{image_format}"\r\n'
+            f"Content-Length: {len(image)}\r\n\r\n"
+        ).encode("ascii")
+        yield image
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode("ascii")
+
+def page_stream_response(pages: Iterator, response_mode: str, image_format: str, headers: Optional[Dict[str, str]] = None) -> StreamingResponse:
+    """
+    Stream converted pages: base64 strings for ``ndjson``, raw bytes for ``multipart``.
+    The first page is converted before the response starts (see prefetch_first).
+    """
+    pages = prefetch_first(iter(pages))
+    if response_mode == "ndjson":
+        return StreamingResponse(ndjson_pages(pages, image_format), media_type="application/x-ndjson", headers=headers)
+    boundary = uuid.uuid4().hex
+    return StreamingResponse(
+        multipart_pages(pages, image_format, boundary),
+        media_type=f"multipart/mixed; boundary={boundary}",
+        headers=headers,
+    )
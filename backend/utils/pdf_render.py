@@ -0,0 +1,100 @@
+import io
+import os
+import base64
+import tempfile
+from typing import Optional
+
+from PIL import Image
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+# Rasterization settings for pages fed to the model. PDF_RENDER_MAX_SIDE=0 means
+# "match the processor's input size" (see model_api.image_input_size)
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", "150"))
+PDF_RENDER_MAX_SIDE = int(os.getenv("PDF_RENDER_MAX_SIDE", "0"))
+# Default quality for lossy page images returned to clients (WebP/JPEG)
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+
+# Output format name -> (PIL format, media type)
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+# Functions below are plain top-level functions so they can run in the
+# conversion process pool (see utils.conversion)
+
+
+def is_pdf_file(path: str) -> bool:
+    """Whether the file is a PDF, by its header: stored uploads need not keep their extension"""
+    with open(path, "rb") as f:
+        return f.read(1024).lstrip().startswith(b"%PDF-")
+
+def pdf_page_count(pdf_path: str) -> int:
+    return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+def render_pdf_page(pdf_path: str, page: int, dpi: int = PDF_RENDER_DPI, max_side: Optional[int] = None) -> Image.Image:
+    """
+    Rasterize a single 1-based page. With ``max_side`` poppler scales the longest side
+    to that many pixels directly, instead of rendering at full DPI and resizing afterwards.
+    """
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=page, last_page=page, size=max_side or None)
+    if not images:
+        raise ValueError(f"Page {page} could not be rendered")
+    return images[0]
+
+def encode_image(img: Image.Image, image_format: str = "png", quality: int = IMAGE_QUALITY) -> bytes:
+    """Encode an image as PNG (lossless, ``quality`` ignored), WebP or JPEG"""
+    pil_format = IMAGE_FORMATS[image_format][0]
+    if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    if pil_format == "PNG":
+        img.save(buf, format=pil_format)
+    else:
+        img.save(buf, format=pil_format, quality=quality)
+    return buf.getvalue()
+
+def render_pdf_page_bytes(pdf_path: str, page: int, dpi: int = 200, image_format: str = "png", quality: int = IMAGE_QUALITY) -> bytes:
+    """Render one page and return the encoded image bytes (default DPI matches convert_from_path)"""
+    return encode_image(render_pdf_page(pdf_path, page, dpi=dpi), image_format, quality)
+
+def render_pdf_page_base64(pdf_path: str, page: int, dpi: int = 200, image_format: str = "png", quality: int = IMAGE_QUALITY) -> str:
+    """Render one page and return it base64-encoded"""
+    return base64.b64encode(render_pdf_page_bytes(pdf_path, page, dpi, image_format, quality)).decode("utf-8")
+
+def image_file_bytes(image_path: str, image_format: str = "png", quality: int = IMAGE_QUALITY) -> bytes:
+    """Re-encode an image file in ``image_format``"""
+    with Image.open(image_path) as img:
+        return encode_image(img, image_format, quality)
+
+def image_file_base64(image_path: str, image_format: str = "png", quality: int = IMAGE_QUALITY) -> str:
+    """Re-encode an image file in ``image_format`` and return it base64-encoded"""
+    return base64.b64encode(image_file_bytes(image_path, image_format, quality)).decode("utf-8")
+
+def render_to_file(source_path: str, target_path: str, page: int = 1, dpi: int = PDF_RENDER_DPI, max_side: Optional[int] = None,
+                   image_format: str = "png", quality: int = IMAGE_QUALITY) -> int:
+    """
+    Render a PDF page, or downscale an image file, to ``target_path`` and return its size in bytes.
+    The file is written under a temporary name and renamed, so readers never see a partial render.
+    """
+    if is_pdf_file(source_path):
+        img = render_pdf_page(source_path, page, dpi=dpi, max_side=max_side)
+    else:
+        if page != 1:
+            raise ValueError("Images have a single page")
+        img = Image.open(source_path)
+        if max_side:
+            img.thumbnail((max_side, max_side))
+    data = encode_image(img, image_format, quality)
+
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(target_path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(data)
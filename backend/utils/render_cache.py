@@ -0,0 +1,146 @@
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from utils.conversion import ConversionQueueFull, conversion_service
+from utils.file_storage import file_content_hash
+from utils.locks import StripedLock
+from utils.lru_cache import LRUCache
+from utils.pdf_render import IMAGE_QUALITY, PDF_RENDER_DPI, render_to_file
+
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", "render_cache")
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+RENDER_CACHE_MAX_FILES = int(os.getenv("RENDER_CACHE_MAX_FILES", "100000"))
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "256"))
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "1600"))
+
+# Rendition name -> (longest side in pixels, image format) served by the preview endpoint
+RENDITIONS: Dict[str, Tuple[int, str]] = {
+    "thumbnail": (THUMBNAIL_SIZE, "webp"),
+    "page": (PREVIEW_SIZE, "webp"),
+}
+
+
+class RenderCache:
+    """
+    On-disk cache of rendered pages and thumbnails of stored uploads.
+
+    Renders are keyed by the upload's content hash plus the render parameters, so
+    the same document uploaded twice (or by two users) is rendered once. Total size
+    is bounded with LRU eviction; access times survive restarts as file mtimes.
+    """
+
+    def __init__(self, directory: str = RENDER_CACHE_DIR, max_bytes: int = RENDER_CACHE_MAX_BYTES, max_files: int = RENDER_CACHE_MAX_FILES):
+        self.directory = directory
+        self._entries = LRUCache(max_entries=max_files, max_bytes=max_bytes, on_evict=self._delete)
+        self._render_locks = StripedLock()
+        self._load_lock = threading.Lock()
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        """Index renders left on disk by a previous run, least recently used first"""
+        with self._load_lock:
+            if self._loaded:
+                return
+            found = []
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if name.startswith("."):
+                        # Temporary file of a render in progress
+                        continue
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, path, stat.st_size))
+            for _, path, size in sorted(found):
+                self._entries.put(path, size, size=size)
+            self._loaded = True
+
+    def _delete(self, path: str, _size: int = 0):
+        try:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            # Already gone, or the directory still holds other renders
+            pass
+
+    def path_for(self, digest: str, page: int, dpi: int, max_side: Optional[int], image_format: str, quality: int) -> str:
+        name = f"p{page}-{dpi}dpi-{max_side or 'full'}-q{quality}.{image_format}"
+        return os.path.join(self.directory, digest[:2], digest, name)
+
+    def _read(self, path: str, count_lookup: bool = True) -> Optional[bytes]:
+        indexed = self._entries.get(path) is not None if count_lookup else path in self._entries
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            if indexed:
+                # Evicted by another worker process
+                self._entries.pop(path)
+            return None
+        if not indexed:
+            # Rendered by another worker process
+            self._entries.put(path, len(data), size=len(data))
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def get(self, source_path: str, page: int = 1, dpi: int = PDF_RENDER_DPI, max_side: Optional[int] = None,
+            image_format: str = "png", quality: int = IMAGE_QUALITY) -> bytes:
+        """
+        Return the encoded render of a stored file's 1-based ``page``, rendering it on the
+        conversion pool on a miss. Concurrent misses for the same render wait for one render.
+        """
+        digest = file_content_hash(source_path)
+        if digest is None:
+            raise FileNotFoundError(source_path)
+        self._ensure_loaded()
+        path = self.path_for(digest, page, dpi, max_side, image_format, quality)
+
+        data = self._read(path)
+        if data is not None:
+            return data
+        with self._render_locks(path):
+            data = self._read(path, count_lookup=False)
+            if data is not None:
+                return data
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            conversion_service.run(render_to_file, source_path, path, page, dpi, max_side, image_format, quality)
+            with open(path, "rb") as f:
+                data = f.read()
+            if not self._entries.put(path, len(data), size=len(data)):
+                # Larger than the whole cache
+                self._delete(path)
+            return data
+
+    def get_rendition(self, source_path: str, rendition: str, page: int = 1) -> bytes:
+        max_side, image_format = RENDITIONS[rendition]
+        return self.get(source_path, page, max_side=max_side, image_format=image_format)
+
+    def prewarm(self, source_path: str, rendition: str = "thumbnail", page: int = 1):
+        """Render in the background so the first preview is a cache hit; skipped when the pool is busy"""
+        digest = file_content_hash(source_path)
+        if digest is None:
+            return
+        self._ensure_loaded()
+        max_side, image_format = RENDITIONS[rendition]
+        path = self.path_for(digest, page, PDF_RENDER_DPI, max_side, image_format, IMAGE_QUALITY)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            job = conversion_service.submit(render_to_file, source_path, path, page, PDF_RENDER_DPI, max_side, image_format, IMAGE_QUALITY)
+        except ConversionQueueFull:
+            return
+
+        def index(done):
+            if not done.cancelled() and done.exception() is None:
+                self._entries.put(path, done.result(), size=done.result())
+        job.add_done_callback(index)
+
+    def stats(self) -> Dict[str, object]:
+        return self._entries.stats()
+
+
+render_cache = RenderCache()
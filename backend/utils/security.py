@@ -0,0 +1,59 @@
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from jose import JWTError, jwt
+from fastapi import Depends, HTTPException
+from fastapi.security import OAuth2PasswordBearer
+
+from utils.lru_cache import LRUCache
+
+SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
+ALGORITHM = os.getenv("ALGORITHM", "HS256")
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+
+# Claims of verified tokens, kept until the token expires or for at most the TTL (0 entries disables)
+AUTH_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_TOKEN_CACHE_MAX_ENTRIES", "10000"))
+AUTH_TOKEN_CACHE_TTL_SECONDS = float(os.getenv("AUTH_TOKEN_CACHE_TTL_SECONDS", "300"))
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/oauth2/login/google")
+
+token_cache = LRUCache(max_entries=AUTH_TOKEN_CACHE_MAX_ENTRIES)
+
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    to_encode = data.copy()
+    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+def verify_token(token: str) -> Dict[str, Any]:
+    """
+    Claims of a valid token with a subject, raising 401 otherwise. Verified claims are
+    cached, never past the token's ``exp``, so repeat requests skip signature checks.
+    Invalid tokens are not cached.
+    """
+    claims = token_cache.get(token)
+    if claims is not None:
+        return claims
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if claims.get("sub") is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    ttl = AUTH_TOKEN_CACHE_TTL_SECONDS
+    if claims.get("exp") is not None:
+        ttl = min(ttl, claims["exp"] - time.time())
+    if ttl > 0:
+        token_cache.put(token, claims, size=0, ttl=ttl)
+    return claims
+
+def get_token_claims(token: str = Depends(oauth2_scheme)) -> Dict[str, Any]:
+    return verify_token(token)
+
+def get_user_id(token: str = Depends(oauth2_scheme)) -> str:
+    return verify_token(token)["sub"]
@@ -0,0 +1,360 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from utils.answer_cache import image_hash
+from utils.generation_profiles import DEFAULT_PROFILE, GenerationProfile
+from utils.inference_backends import MODEL_ID, BatchRequest, InferenceBackend, StopCheck, TextCallback, build_messages
+from utils.kv_cache import common_prefix_length, session_kv_cache, split_cache_row
+from utils.lru_cache import LRUCache
+from utils.metrics import decode_throughput, generated_tokens, observe_stage, timed
+
+# Vision-tower outputs kept on the model's device per image hash, so follow-up questions
+# about the same image skip preprocessing and encoding. 0 bytes disables the cache
+VISION_CACHE_MAX_ENTRIES = int(os.getenv("VISION_CACHE_MAX_ENTRIES", "256"))
+VISION_CACHE_MAX_BYTES = int(os.getenv("VISION_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Intra-op threads for CPU inference (0 leaves torch's default)
+INFERENCE_CPU_THREADS = int(os.getenv("INFERENCE_CPU_THREADS", "0"))
+# generate calls allowed on the shared model at once: the batch scheduler's one batch plus
+# session follow-ups resuming their own KV cache, which cannot join a batch. Without a bound
+# every inference worker thread could be generating at the same time
+INFERENCE_MAX_CONCURRENT_GENERATE = int(os.getenv("INFERENCE_MAX_CONCURRENT_GENERATE", "4"))
+
+
+def _callback_streamer(tokenizer, on_text):
+    from transformers import TextStreamer
+
+    class _CallbackStreamer(TextStreamer):
+        def on_finalized_text(self, text: str, stream_end: bool = False):
+            if text:
+                on_text(text)
+
+    return _CallbackStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+def _stop_criteria(should_stop):
+    from transformers import StoppingCriteria
+
+    class _StopCriteria(StoppingCriteria):
+        # Set once generation has been cut short by should_stop
+        triggered = False
+
+        def __call__(self, input_ids, scores, **kwargs) -> bool:
+            if should_stop():
+                self.triggered = True
+            return self.triggered
+
+    return _StopCriteria()
+
+def _step_timer():
+    from transformers import StoppingCriteria
+
+    class _StepTimer(StoppingCriteria):
+        """Never stops generation; notes when each token is ready, to split prefill from decode"""
+        def __init__(self):
+            self.started = time.perf_counter()
+            self.first_token = None
+            self.steps = 0
+            self.batch_size = 0
+
+        def __call__(self, input_ids, scores, **kwargs):
+            if self.first_token is None:
+                self.first_token = time.perf_counter()
+            self.steps += 1
+            self.batch_size = input_ids.shape[0]
+            return False
+
+        def record(self):
+            if self.first_token is None:
+                return
+            finished = time.perf_counter()
+            observe_stage("generate_prefill", self.first_token - self.started)
+            observe_stage("generate_decode", finished - self.first_token)
+            generated_tokens.inc(self.batch_size, "prefill")
+            decoded = (self.steps - 1) * self.batch_size
+            generated_tokens.inc(decoded, "decode")
+            if decoded and finished > self.first_token:
+                decode_throughput.observe(decoded / (finished - self.first_token))
+
+    return _StepTimer()
+
+def quantize_dynamic_int8(model):
+    """Int8 weights with activations quantized on the fly, for the Linear layers that dominate CPU time"""
+    import torch
+
+    try:
+        from torchao.quantization import Int8DynamicActivationInt8WeightConfig, quantize_
+    except ImportError:
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    quantize_(model, Int8DynamicActivationInt8WeightConfig())
+    return model
+
+
+class TransformersBackend(InferenceBackend):
+    """
+    In-process generation with transformers: bfloat16 spread over the available devices
+    by default, or float32 on CPU with dynamically quantized int8 Linear layers
+    (``quantize_int8``) for nodes without a GPU. Keeps the vision-embedding cache and
+    reuses per-session KV caches (utils.kv_cache).
+    """
+    name = "transformers"
+
+    def __init__(self, model_id: str = MODEL_ID, quantize_int8: bool = False):
+        super().__init__(model_id)
+        self.quantize_int8 = quantize_int8
+        if quantize_int8:
+            self.name = "cpu-int8"
+            self.quantization = "int8-dynamic"
+        self.model = None
+        self.processor = None
+        self.dtype = None
+        self.vision_cache = LRUCache(max_entries=VISION_CACHE_MAX_ENTRIES, max_bytes=VISION_CACHE_MAX_BYTES)
+        self._generate_slots = threading.BoundedSemaphore(max(1, INFERENCE_MAX_CONCURRENT_GENERATE))
+
+    def load(self):
+        # torch and transformers are imported here rather than at module level
+        # so that importing the app stays fast for routes that never touch the model
+        import torch
+        from transformers import AutoProcessor, AutoModelForImageTextToText
+
+        processor = AutoProcessor.from_pretrained(self.model_id)
+        # Decoder-only generation needs left padding so every prompt ends at the same position
+        processor.tokenizer.padding_side = "left"
+        if self.quantize_int8:
+            if INFERENCE_CPU_THREADS > 0:
+                torch.set_num_threads(INFERENCE_CPU_THREADS)
+            model = AutoModelForImageTextToText.from_pretrained(self.model_id, torch_dtype=torch.float32)
+            model = quantize_dynamic_int8(model.eval())
+            dtype = torch.float32
+        else:
+            model = AutoModelForImageTextToText.from_pretrained(self.model_id, torch_dtype=torch.bfloat16, device_map="auto")
+            dtype = torch.bfloat16
+        self.processor, self.model, self.dtype = processor, model, dtype
+
+    def image_input_size(self, default: int = 896) -> int:
+        size = getattr(getattr(self.processor, "image_processor", None), "size", None) or {}
+        return max(size.get("height", 0), size.get("width", 0), size.get("longest_edge", 0)) or default
+
+    def _supports_vision_cache(self) -> bool:
+        # Needs a Gemma 3 style processor, which expands each image into a fixed run of image tokens
+        return (
+            VISION_CACHE_MAX_BYTES > 0
+            and all(hasattr(self.processor, name) for name in ("boi_token", "full_image_sequence"))
+            and self._image_token_id() is not None
+            and hasattr(self.model, "get_image_features")
+        )
+
+    def _image_token_id(self) -> Optional[int]:
+        # The model's own placeholder id; newer processors use image_token_id for the begin-of-image token
+        config = getattr(self.model, "config", None)
+        token_id = getattr(config, "image_token_id", None)
+        if token_id is None:
+            token_id = getattr(config, "image_token_index", None)
+        return token_id
+
+    def image_features(self, image: Image.Image):
+        """Vision-tower embeddings of one image, from the vision cache when it has been seen before"""
+        import torch
+
+        key = image_hash(image)
+        features = self.vision_cache.get(key)
+        if features is None:
+            pixel_values = self.processor.image_processor(images=[image], return_tensors="pt")["pixel_values"]
+            with torch.inference_mode(), timed("vision_encode"):
+                features = self.model.get_image_features(pixel_values.to(self.model.device, dtype=self.dtype))
+            # Newer transformers return a model output with the projected embeddings as pooler_output
+            features = getattr(features, "pooler_output", features)
+            self.vision_cache.put(key, features, size=features.numel() * features.element_size())
+        return features
+
+    def prepare_inputs(self, conversations: List[List[Dict[str, Any]]], images: Sequence[Optional[Image.Image]],
+                       padding: bool = False):
+        """
+        Tokenize conversations for generate. Image conversations get their image embeddings
+        from image_features() merged into ``inputs_embeds`` instead of passing ``pixel_values``,
+        so a repeated image costs neither preprocessing nor a vision-tower pass.
+        """
+        import torch
+
+        processor, model = self.processor, self.model
+        if not any(image is not None for image in images) or not self._supports_vision_cache():
+            with timed("chat_template"):
+                return processor.apply_chat_template(
+                    conversations, add_generation_prompt=True, tokenize=True,
+                    return_dict=True, return_tensors="pt", padding=padding
+                ).to(model.device, dtype=self.dtype)
+
+        # Same expansion of the image placeholder the processor does, without processing the image
+        with timed("chat_template"):
+            texts = processor.apply_chat_template(conversations, add_generation_prompt=True, tokenize=False)
+            texts = [text.replace(processor.boi_token, processor.full_image_sequence) for text in texts]
+            inputs = processor.tokenizer(texts, return_tensors="pt", padding=padding, add_special_tokens=False).to(model.device)
+        image_mask = inputs["input_ids"] == self._image_token_id()
+        with torch.inference_mode():
+            embeds = model.get_input_embeddings()(inputs["input_ids"].masked_fill(image_mask, 0))
+            features = torch.cat([self.image_features(image) for image in images if image is not None])
+            embeds = embeds.masked_scatter(image_mask.unsqueeze(-1).expand_as(embeds), features.to(embeds.device, embeds.dtype))
+        inputs["inputs_embeds"] = embeds
+        # Lets the model attend bidirectionally within each image, as it does with pixel_values
+        inputs["token_type_ids"] = image_mask.long()
+        return inputs
+
+    @contextmanager
+    def _generate_slot(self):
+        """One of the INFERENCE_MAX_CONCURRENT_GENERATE slots for running the model"""
+        waited = time.perf_counter()
+        with self._generate_slots:
+            observe_stage("generate_wait", time.perf_counter() - waited)
+            yield
+
+    def _generate(self, inputs, profile: GenerationProfile, **generate_kwargs):
+        """
+        model.generate with the profile's settings, in a generate slot; also returns whether
+        it finished within the deadline
+        """
+        import torch
+        from transformers import StoppingCriteriaList
+
+        with self._generate_slot():
+            step_timer = _step_timer()
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([*generate_kwargs.get("stopping_criteria", []), step_timer])
+            started = time.monotonic()
+            with torch.inference_mode():
+                if "inputs_embeds" in inputs:
+                    inputs, generate_kwargs["past_key_values"] = self._prefill_embeds(inputs)
+                output = self.model.generate(**inputs, **profile.generate_kwargs(self.processor.tokenizer), **generate_kwargs)
+            step_timer.record()
+        # Cut off by max_time: a usable but incomplete answer
+        complete = not profile.deadline_seconds or time.monotonic() - started < profile.deadline_seconds
+        return output, complete
+
+    def _prefill_embeds(self, inputs):
+        """
+        Run a prompt given as ``inputs_embeds`` through the model up to its last token, since
+        generate does not take inputs_embeds for Gemma 3; generate goes on from the returned
+        cache with the prompt's token ids. Positions follow the attention mask, as generate's do.
+        """
+        mask = inputs["attention_mask"]
+        positions = (mask.long().cumsum(-1) - 1).masked_fill(mask == 0, 0)
+        cache = self._new_kv_cache()
+        self.model(inputs_embeds=inputs["inputs_embeds"][:, :-1], attention_mask=mask[:, :-1],
+                   token_type_ids=inputs["token_type_ids"][:, :-1], position_ids=positions[:, :-1],
+                   past_key_values=cache, use_cache=True)
+        return {"input_ids": inputs["input_ids"], "attention_mask": mask}, cache
+
+    def generate_batch(self, requests: Sequence[BatchRequest],
+                       profile: GenerationProfile = DEFAULT_PROFILE) -> List[Tuple[str, bool]]:
+        """
+        Answer requests as one left-padded batch. Text-only session turns leave their share
+        of the batch's KV cache in the session cache, so the session's next turn can resume it.
+        """
+        # Text-only and image prompts are generated separately so the processor
+        # never sees a batch with a mix of samples with and without images
+        results = [None] * len(requests)
+        groups = {}
+        for i, (image, _, _, _) in enumerate(requests):
+            groups.setdefault(image is not None, []).append(i)
+        for has_image, indices in groups.items():
+            conversations = [build_messages(*requests[i][:3], system_prompt=profile.system_prompt) for i in indices]
+            inputs = self.prepare_inputs(conversations, [requests[i][0] for i in indices], padding=True)
+            input_len = inputs["input_ids"].shape[-1]
+            keep_cache = not has_image and session_kv_cache.enabled and any(requests[i][3] is not None for i in indices)
+            output, complete = self._generate(inputs, profile, return_dict_in_generate=keep_cache)
+            sequences = output.sequences if keep_cache else output
+            if keep_cache and output.past_key_values is not None:
+                self._store_batch_caches([requests[i][3] for i in indices], inputs, sequences, output.past_key_values)
+            answers = self.processor.batch_decode(sequences[:, input_len:], skip_special_tokens=True)
+            for i, answer in zip(indices, answers):
+                results[i] = (profile.trim(answer), complete)
+        return results
+
+    def _store_batch_caches(self, session_keys: Sequence[Optional[Tuple[str, str]]], inputs, sequences, cache):
+        cached = cache.get_seq_length()
+        input_len = inputs["input_ids"].shape[-1]
+        for row, session_key in enumerate(session_keys):
+            if session_key is None:
+                continue
+            padding = input_len - int(inputs["attention_mask"][row].sum())
+            row_cache = split_cache_row(cache, row, padding, self._new_kv_cache())
+            if row_cache is None:
+                return
+            session_kv_cache.store(session_key, sequences[row, padding:cached].tolist(), row_cache)
+
+    def reuses_session(self, image: Optional[Image.Image], history: Sequence[Dict[str, str]],
+                       session_key: Optional[Tuple[str, str]]) -> bool:
+        # generate_turn only resumes a cache for text turns; image turns prefill from scratch
+        return image is None and bool(history) and session_kv_cache.has_session(session_key)
+
+    def _new_kv_cache(self):
+        from transformers import DynamicCache
+
+        try:
+            return DynamicCache(config=self.model.config)
+        except TypeError:
+            return DynamicCache()
+
+    def _ensure_system_prefix(self, system_prompt: str):
+        """Prefill the system-prompt prefix shared by every conversation once, to seed session caches"""
+        import torch
+
+        if session_kv_cache.has_prefix(system_prompt):
+            return
+        # The prefill runs the model, so it takes a generate slot like any generation;
+        # the slot is taken first so nothing waits for one while holding the prefix lock
+        with self._generate_slot(), session_kv_cache.prefix_lock:
+            if session_kv_cache.has_prefix(system_prompt):
+                return
+            # The template may fold the system prompt into the first user turn, so take the
+            # tokens two different questions have in common rather than templating it alone
+            texts = self.processor.apply_chat_template(
+                [build_messages(query="a", system_prompt=system_prompt), build_messages(query="b", system_prompt=system_prompt)],
+                add_generation_prompt=True, tokenize=False
+            )
+            ids_a, ids_b = self.processor.tokenizer(texts, add_special_tokens=False)["input_ids"]
+            prefix = ids_a[:common_prefix_length(ids_a, ids_b)]
+            if not prefix:
+                return
+            cache = self._new_kv_cache()
+            with torch.inference_mode():
+                self.model(input_ids=torch.tensor([prefix], device=self.model.device), past_key_values=cache, use_cache=True)
+            session_kv_cache.set_prefix(system_prompt, prefix, cache)
+
+    def generate_turn(self, image: Image.Image = None, query: str = "", history: Sequence[Dict[str, str]] = (),
+                      session_key: Optional[Tuple[str, str]] = None, profile: GenerationProfile = DEFAULT_PROFILE,
+                      on_text: TextCallback = None, should_stop: StopCheck = None) -> Tuple[str, bool]:
+        """
+        Generate one conversational turn as a single sequence, reusing the KV cache of the
+        session's previous turn (or of the shared system prompt) so only new tokens are prefilled.
+        Turns with an image are generated from scratch: their image embeddings are only
+        merged into the model inputs on a full prefill.
+        """
+        from transformers import StoppingCriteriaList
+
+        inputs = self.prepare_inputs([build_messages(image, query, history, profile.system_prompt)], [image])
+        input_len = inputs["input_ids"].shape[-1]
+        reuse = image is None and session_kv_cache.enabled
+        past = None
+        if reuse:
+            self._ensure_system_prefix(profile.system_prompt)
+            past, _ = session_kv_cache.take(session_key, inputs["input_ids"][0].tolist())
+            past = past if past is not None else self._new_kv_cache()
+
+        generate_kwargs = {}
+        if on_text is not None:
+            generate_kwargs["streamer"] = _callback_streamer(self.processor.tokenizer, on_text)
+        stop = _stop_criteria(should_stop) if should_stop is not None else None
+        if stop is not None:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([stop])
+        output, complete = self._generate(inputs, profile, past_key_values=past, return_dict_in_generate=True, **generate_kwargs)
+        sequence = output.sequences[0]
+        if reuse and session_key is not None and output.past_key_values is not None:
+            cache = output.past_key_values
+            session_kv_cache.store(session_key, sequence[:cache.get_seq_length()].tolist(), cache)
+        complete = complete and not (stop is not None and stop.triggered)
+        return profile.trim(self.processor.decode(sequence[input_len:], skip_special_tokens=True)), complete
+
+    def stats(self) -> Dict[str, Any]:
+        return {"vision": self.vision_cache.stats()}
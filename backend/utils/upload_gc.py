@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+from typing import Any, Dict, Iterable, List
+
+from utils.file_storage import USERS_DIR, delete_orphan, expire_upload_claims, rebuild_file_refs
+from utils.history_store import HistoryStore
+
+# Seconds between sweeps of every user's uploads (0 disables the background sweep)
+UPLOAD_GC_INTERVAL_SECONDS = float(os.getenv("UPLOAD_GC_INTERVAL_SECONDS", "3600"))
+# Uploads younger than this are kept even when unreferenced: their message may not be saved yet
+UPLOAD_GC_GRACE_SECONDS = float(os.getenv("UPLOAD_GC_GRACE_SECONDS", "3600"))
+# Rate limits, so a sweep never competes with requests for disk I/O
+UPLOAD_GC_MAX_DELETES_PER_SECOND = float(os.getenv("UPLOAD_GC_MAX_DELETES_PER_SECOND", "20"))
+UPLOAD_GC_USER_PAUSE_MS = float(os.getenv("UPLOAD_GC_USER_PAUSE_MS", "50"))
+
+
+def message_file_paths(messages: Iterable[Dict[str, Any]]) -> List[str]:
+    return [message["filePath"] for message in messages if message.get("filePath")]
+
+
+class OrphanSweeper:
+    """
+    Background job reconciling the upload index with chat history.
+
+    For one user at a time it recounts file references from every stored message,
+    rewrites the index and deletes stored files that nothing references and that are
+    older than the grace period. This corrects index drift (crashes between a history
+    write and its index update, uploads never attached to a message, files stored
+    before the index existed) without doing any of that work in requests.
+
+    Recounting holds the history store's user lock, which routes hold around a history
+    write and the matching index update, so the count never misses a message.
+    """
+
+    def __init__(
+        self,
+        history_store: HistoryStore,
+        interval: float = UPLOAD_GC_INTERVAL_SECONDS,
+        grace_seconds: float = UPLOAD_GC_GRACE_SECONDS,
+        max_deletes_per_second: float = UPLOAD_GC_MAX_DELETES_PER_SECOND,
+        user_pause_ms: float = UPLOAD_GC_USER_PAUSE_MS,
+    ):
+        self.history_store = history_store
+        self.interval = interval
+        self.grace_seconds = grace_seconds
+        self.delete_interval = 1.0 / max_deletes_per_second if max_deletes_per_second > 0 else 0.0
+        self.user_pause = user_pause_ms / 1000.0
+        self._stop = threading.Event()
+        self._thread = None
+        self.sweeps = 0
+        self.users_swept = 0
+        self.files_deleted = 0
+        self.errors = 0
+        self.last_sweep_seconds = None
+
+    def start(self) -> bool:
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="upload-gc", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sweep()
+
+    def sweep_user(self, user_id: str) -> int:
+        """Reconcile one user's uploads, returning the number of files deleted"""
+        with self.history_store.user_lock(user_id):
+            sessions = self.history_store.load_sessions(user_id)
+            paths = [path for session in sessions for path in message_file_paths(session.get("messages", []))]
+            orphans = rebuild_file_refs(user_id, paths)
+        # Uploads past the grace period whose request never attached them to a message
+        expire_upload_claims(user_id, self.grace_seconds)
+        deleted = 0
+        for filename in orphans:
+            if self._stop.is_set():
+                break
+            with self.history_store.user_lock(user_id):
+                removed = delete_orphan(user_id, filename, self.grace_seconds)
+            if removed:
+                deleted += 1
+                self.files_deleted += 1
+                self._stop.wait(self.delete_interval)
+        self.users_swept += 1
+        return deleted
+
+    def sweep(self) -> int:
+        """Reconcile every user's uploads, returning the number of files deleted"""
+        started = time.monotonic()
+        deleted = 0
+        try:
+            user_ids = [entry.name for entry in os.scandir(USERS_DIR) if entry.is_dir()]
+        except FileNotFoundError:
+            user_ids = []
+        for user_id in user_ids:
+            if self._stop.is_set():
+                break
+            try:
+                deleted += self.sweep_user(user_id)
+            except Exception:
+                # One unreadable history must not stop the sweep of everyone else
+                self.errors += 1
+            self._stop.wait(self.user_pause)
+        self.sweeps += 1
+        self.last_sweep_seconds = time.monotonic() - started
+        return deleted
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sweeps": self.sweeps,
+            "users_swept": self.users_swept,
+            "files_deleted": self.files_deleted,
+            "errors": self.errors,
+            "last_sweep_seconds": self.last_sweep_seconds,
+        }
@@ -8,6 +8,7 @@ interface ChatMessage {
   fileName?: string;
   filePath?: string;
   timestamp?: string;
+  error?: boolean;
 }
 
 interface ChatMainPanelProps {
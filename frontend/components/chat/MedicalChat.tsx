@@ -10,6 +10,8 @@ interface ChatMessage {
   fileName?: string;
   filePath?: string;
   timestamp?: string;
+  // Set on failure notices, which are shown but never sent back to the model as context
+  error?: boolean;
 }
 
 interface ChatSession {
@@ -125,6 +127,7 @@ export default function MedicalChat({ LogoutButton }: MedicalChatProps) {
     try {
       const form = new FormData();
       form.append("question", input);
+      form.append("session_id", activeChatId);
       if (file) form.append("file", file);
       const controller = new AbortController();
       const timeoutId = setTimeout(() => controller.abort(), 60000);
@@ -156,6 +159,7 @@ export default function MedicalChat({ LogoutButton }: MedicalChatProps) {
           sender: "ai",
           text: `Error: Unable to get response from AI. Status: ${res.status}`,
           timestamp: new Date().toISOString(),
+          error: true,
         };
       }
       setChats((prev) =>
@@ -208,7 +212,7 @@ export default function MedicalChat({ LogoutButton }: MedicalChatProps) {
                 ...chat,
                 messages: [
                   ...chat.messages,
-                  { sender: "ai", text: errorMessage, timestamp: new Date().toISOString() },
+                  { sender: "ai", text: errorMessage, timestamp: new Date().toISOString(), error: true },
                 ],
               }
             : chat